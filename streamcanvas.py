@@ -24,7 +24,7 @@ def add_options_arguments(parser):
 
         # If type is an enum, wrap it in something that knows how to convert a string to an enum
         if issubclass(type_, Enum):
-            type_creator = lambda str_: type_[str_]
+            type_creator = lambda str_, type_=type_: type_[str_]
         else:
             type_creator = type_
 
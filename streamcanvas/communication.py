@@ -1,46 +1,318 @@
 ''' Functions for performing communication between plotter and gobbler '''
 
+import io
+import os
+import struct
 import sys
+import threading
 
-from itertools import chain
+# Shared memory is only available from Python 3.8, without which we fall back to the binary protocol
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    resource_tracker = shared_memory = None
 
-from streamcanvas.constants import RESPONSE_ACKNOWLEDGE, SIGNAL_ENTER_DROP_MODE, SIGNAL_ENTER_NODROP_MODE
-from streamcanvas.options import DisplayMode, OPTIONS
+from streamcanvas.constants import (NOTIFY_FD_ENVIRONMENT_VARIABLE, RESPONSE_ACKNOWLEDGE, RESPONSE_BEGIN_PARTIAL_FRAME,
+                                    RESPONSE_COMPLETE_FRAME, RESPONSE_CONTINUE_PARTIAL_FRAME,
+                                    RESPONSE_END_PARTIAL_FRAME, SIGNAL_ENTER_DROP_MODE, SIGNAL_ENTER_NODROP_MODE,
+                                    SIGNAL_NOTIFY_ON_NEW_DATA, SIGNAL_SEND_COMPILED_FRAMES,
+                                    SIGNAL_USE_BINARY_PROTOCOL, SIGNAL_USE_SHARED_MEMORY)
+from streamcanvas.options import DisplayMode, FrameFormat, OPTIONS, Protocol
 
 
-def send_response_and_data(stream, response, data):
-    ''' Send the given signal and data, on the given stream which may contain multiple lines '''
-    data_lines = data.split('\n')
-    response_and_num_lines = '{} {}'.format(response, len(data_lines))
+# In the binary protocol, each message starts with the response byte and the length of the payload that follows
+_BINARY_HEADER = struct.Struct('<cQ')
 
-    for line_to_send in chain((response_and_num_lines,), data_lines):
-        stream.write('{}\n'.format(line_to_send).encode('ascii'))
+# With shared memory, we also say whether the payload is a descriptor of data in shared memory
+_SHARED_MEMORY_HEADER = struct.Struct('<c?Q')
 
+# A descriptor gives the slot, the generation of the data, and its offset and length in the segment. The name of the
+# segment follows.
+_SHARED_MEMORY_DESCRIPTOR = struct.Struct('<BQQQ')
 
-def read_response_and_data(signal):
-    ''' Read and return a response and data from the gobbler after sending the given signal. Doesn't catch exceptions'''
+# Each segment starts with the generation of the data it holds, so that we can tell if it has been overwritten
+_SHARED_MEMORY_GENERATION = struct.Struct('<Q')
+
+# Payloads smaller than this aren't worth putting in shared memory
+_SHARED_MEMORY_THRESHOLD = 1 << 16
+
+# The size with which the plotter's receive buffer starts out. It grows to fit the largest message received.
+_INITIAL_RECEIVE_BUFFER_SIZE = 1 << 16
+
+# The responses that carry frame data, which is compiled rather than text once we've asked for compiled frames
+FRAME_RESPONSES = frozenset((RESPONSE_COMPLETE_FRAME, RESPONSE_BEGIN_PARTIAL_FRAME, RESPONSE_CONTINUE_PARTIAL_FRAME,
+                             RESPONSE_END_PARTIAL_FRAME))
+
+
+class SharedMemorySender:
+    ''' Sends messages in the shared memory protocol. Large payloads are written to one of two shared memory segments
+        in turn, so that the plotter can still be reading one while we write the next. Only a small descriptor then
+        goes down the pipe.
+    '''
+
+    def __init__(self):
+        self._segments = [None, None]
+        self._next_slot = 0
+        self._generation = 0
+
+    def send_response_and_data(self, stream, response, data):
+        ''' Send the given response and data, which is either text or bytes, on the given stream '''
+        payload = _encode_payload(data)
+        if len(payload) < _SHARED_MEMORY_THRESHOLD:
+            stream.writelines((_SHARED_MEMORY_HEADER.pack(response.encode('ascii'), False, len(payload)), payload))
+            return
+
+        slot = self._next_slot
+        self._next_slot = 1 - slot
+        self._generation += 1
+        segment = self._segment(slot, _SHARED_MEMORY_GENERATION.size + len(payload))
+        _SHARED_MEMORY_GENERATION.pack_into(segment.buf, 0, self._generation)
+        segment.buf[_SHARED_MEMORY_GENERATION.size:_SHARED_MEMORY_GENERATION.size + len(payload)] = payload
+
+        descriptor = (_SHARED_MEMORY_DESCRIPTOR.pack(slot, self._generation, _SHARED_MEMORY_GENERATION.size,
+                                                     len(payload))
+                      + segment.name.encode('ascii'))
+        stream.writelines((_SHARED_MEMORY_HEADER.pack(response.encode('ascii'), True, len(descriptor)), descriptor))
+
+    def _segment(self, slot, size):
+        ''' Return the segment for the given slot, replacing it with a larger one if it is smaller than size '''
+        segment = self._segments[slot]
+        if segment is None or segment.size < size:
+            if segment is not None:
+                # The plotter keeps its own mapping of the old segment for as long as it needs it
+                segment.close()
+                segment.unlink()
+            old_size = 0 if segment is None else segment.size
+            segment = shared_memory.SharedMemory(create=True, size=max(size, 2 * old_size))
+            self._segments[slot] = segment
+        return segment
+
+    def close(self):
+        ''' Release the shared memory segments '''
+        for segment in self._segments:
+            if segment is not None:
+                segment.close()
+                segment.unlink()
+        self._segments = [None, None]
+
+
+class BinaryReceiver:
+    ''' Receives messages in the binary protocol from a file descriptor, reading into a single reusable buffer.
+
+        We read as much as is available each time, so anything beyond the current message is kept for the next one.
+        If use_shared_memory is True, we receive messages in the shared memory protocol instead. The data of any
+        response in raw_responses is returned as bytes rather than decoded as text.
+    '''
+
+    def __init__(self, fd, use_shared_memory=False):
+        self._use_shared_memory = use_shared_memory
+        self.raw_responses = frozenset()
+        # The segment that we have open for each slot
+        self._segments = [None, None]
+        self._file = io.FileIO(fd, closefd=False)
+        self._buffer = bytearray(_INITIAL_RECEIVE_BUFFER_SIZE)
+        # The received data that we haven't yet returned is self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+
+    def read_message(self):
+        ''' Read a single message, and return its response and data '''
+        if not self._use_shared_memory:
+            response, length = _BINARY_HEADER.unpack(self._read(_BINARY_HEADER.size))
+            response = response.decode('ascii')
+            return response, self._decode_payload(response, self._read(length))
+
+        response, in_shared_memory, length = _SHARED_MEMORY_HEADER.unpack(self._read(_SHARED_MEMORY_HEADER.size))
+        response = response.decode('ascii')
+        if not in_shared_memory:
+            return response, self._decode_payload(response, self._read(length))
+
+        descriptor = self._read(length)
+        slot, generation, offset, length = _SHARED_MEMORY_DESCRIPTOR.unpack_from(descriptor)
+        segment = self._segment(slot, str(descriptor[_SHARED_MEMORY_DESCRIPTOR.size:], 'ascii'))
+        if _SHARED_MEMORY_GENERATION.unpack_from(segment.buf, 0)[0] != generation:
+            raise RuntimeError('Data in shared memory was overwritten before we read it')
+        return response, self._decode_payload(response, segment.buf[offset:offset + length])
+
+    def _decode_payload(self, response, payload):
+        ''' Return the data in the given payload for the given response '''
+        if response in self.raw_responses:
+            # The receive buffer and shared memory slots are reused for later messages while this one may still be
+            # waiting to be used, so we copy it once here, and it is decoded from this copy without any more
+            return bytes(payload)
+        return str(payload, 'utf-8')
+
+    def _segment(self, slot, name):
+        ''' Return the segment with the given name, which is to be used for the given slot '''
+        segment = self._segments[slot]
+        if segment is None or segment.name != name:
+            if segment is not None:
+                segment.close()
+            segment = shared_memory.SharedMemory(name=name)
+            # The gobbler owns the segment, so we mustn't let our resource tracker remove it when we exit
+            resource_tracker.unregister(segment._name, 'shared_memory')
+            self._segments[slot] = segment
+        return segment
+
+    def _read(self, size):
+        ''' Return a view of the next size bytes, reading more if we don't yet have them. The view is only valid until
+            the next read.
+        '''
+        if self._end - self._start < size:
+            self._make_room(size)
+            while self._end - self._start < size:
+                num_read = self._file.readinto(memoryview(self._buffer)[self._end:])
+                if num_read == 0:
+                    raise BrokenPipeError('The gobbler has closed its end of the pipe')
+                self._end += num_read
+
+        view = memoryview(self._buffer)[self._start:self._start + size]
+        self._start += size
+        return view
+
+    def _make_room(self, size):
+        ''' Ensure that there is space in the buffer for size bytes from the current start '''
+        num_pending = self._end - self._start
+        if len(self._buffer) < size:
+            new_buffer = bytearray(max(size, 2 * len(self._buffer)))
+            new_buffer[:num_pending] = self._buffer[self._start:self._end]
+            self._buffer = new_buffer
+        elif len(self._buffer) - self._start < size:
+            self._buffer[:num_pending] = self._buffer[self._start:self._end]
+        else:
+            return
+        self._start = 0
+        self._end = num_pending
+
+
+# Once the binary protocol has been negotiated, the plotter receives everything through this
+_BINARY_RECEIVER = None
+
+
+def _encode_payload(data):
+    ''' Return the bytes that we send for the given data, which is either text or already bytes '''
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+def send_response_and_data(stream, response, data, protocol=Protocol.lines):
+    ''' Send the given signal and data, on the given stream which may contain multiple lines. Only the binary
+        protocols can send data that is bytes.
+    '''
+    if protocol is Protocol.binary:
+        payload = _encode_payload(data)
+        # Writing both pieces together lets the transport send them with a single system call
+        stream.writelines((_BINARY_HEADER.pack(response.encode('ascii'), len(payload)), payload))
+        return
+
+    num_lines = data.count('\n') + 1
+    stream.write('{} {}\n{}\n'.format(response, num_lines, data).encode('ascii'))
+
+
+def send_signal(signal):
+    ''' Send the given signal to the gobbler. Doesn't catch exceptions '''
     sys.stdout.write(signal)
     sys.stdout.flush()
 
+
+def read_response():
+    ''' Read and return the next response and data from the gobbler. Doesn't catch exceptions '''
+    if _BINARY_RECEIVER is not None:
+        return _BINARY_RECEIVER.read_message()
+
     # We first get a response based on what data is available, and then some data
-    response, num_lines = sys.stdin.readline().strip().split()
-    data = ''
-    for _ in range(int(num_lines)):
-        data += sys.stdin.readline()
+    line = sys.stdin.readline()
+    if len(line) == 0:
+        raise BrokenPipeError('The gobbler has closed its end of the pipe')
+    response, num_lines = line.strip().split()
+    data = ''.join(sys.stdin.readline() for _ in range(int(num_lines)))
     data = data.strip()
 
     return response, data
 
 
-def update_gobbler_dropping_mode():
-    ''' Send a signal to the gobbler based on the current options '''
+def read_response_and_data(signal):
+    ''' Read and return a response and data from the gobbler after sending the given signal. Doesn't catch exceptions'''
+    send_signal(signal)
+    return read_response()
+
+
+class ResponseReader(threading.Thread):
+    ''' Reads responses from the gobbler on a thread of its own, so that whoever sends signals needn't wait while a
+        large frame arrives. Each response is passed to response_callback, from this thread, only once its data has
+        been received in full. Once the gobbler has gone away, response_callback is called with None.
+
+        Nothing else may read responses once this has been started.
+    '''
+
+    def __init__(self, response_callback):
+        super().__init__(daemon=True)
+        self._response_callback = response_callback
+
+    def run(self):
+        while True:
+            try:
+                response_and_data = read_response()
+            except BrokenPipeError:
+                self._response_callback(None)
+                return
+            self._response_callback(response_and_data)
+
+
+def negotiate_protocol():
+    ''' Switch to the binary or shared memory protocol if the options ask for it. This must be done before the
+        gobbler sends anything other than the acknowledgement.
+    '''
+    global _BINARY_RECEIVER
+    if OPTIONS.protocol is Protocol.lines or _BINARY_RECEIVER is not None:
+        return
+
+    use_shared_memory = OPTIONS.protocol is Protocol.shared_memory and shared_memory is not None
+    signal = SIGNAL_USE_SHARED_MEMORY if use_shared_memory else SIGNAL_USE_BINARY_PROTOCOL
+    response, _ = read_response_and_data(signal)
+    if response != RESPONSE_ACKNOWLEDGE:
+        raise RuntimeError("Expected acknowledge, got '{}'".format(response))
+
+    # The acknowledgement was the last thing sent as lines, so there is nothing left buffered in sys.stdin
+    _BINARY_RECEIVER = BinaryReceiver(sys.stdin.fileno(), use_shared_memory)
+
+
+def negotiate_frame_format():
+    ''' Ask the gobbler for compiled frames if the options ask for them, and the protocol can carry them. Compiled
+        frames are then received as bytes rather than text.
+    '''
+    if OPTIONS.frame_format is FrameFormat.text or _BINARY_RECEIVER is None:
+        return
+
+    response, _ = read_response_and_data(SIGNAL_SEND_COMPILED_FRAMES)
+    if response != RESPONSE_ACKNOWLEDGE:
+        raise RuntimeError("Expected acknowledge, got '{}'".format(response))
+    _BINARY_RECEIVER.raw_responses = FRAME_RESPONSES
+
+
+def dropping_mode_signal():
+    ''' Return the signal that tells the gobbler which dropping mode to use, based on the current options '''
     if OPTIONS.mode in (DisplayMode.live, DisplayMode.inspect_drop):
-        signal = SIGNAL_ENTER_DROP_MODE
+        return SIGNAL_ENTER_DROP_MODE
     elif OPTIONS.mode == DisplayMode.inspect_nodrop:
-        signal = SIGNAL_ENTER_NODROP_MODE
+        return SIGNAL_ENTER_NODROP_MODE
     else:
         raise RuntimeError("Unknown display mode: {}".format(OPTIONS.mode))
 
-    response, _ = read_response_and_data(signal)
+
+def update_gobbler_dropping_mode():
+    ''' Send a signal to the gobbler based on the current options '''
+    response, _ = read_response_and_data(dropping_mode_signal())
+    if response != RESPONSE_ACKNOWLEDGE:
+        raise RuntimeError("Expected acknowledge, got '{}'".format(response))
+
+
+def enable_new_data_notifications():
+    ''' Ask the gobbler to tell us whenever it has new data, and return the file descriptor that will become readable
+        when it does
+    '''
+    response, _ = read_response_and_data(SIGNAL_NOTIFY_ON_NEW_DATA)
     if response != RESPONSE_ACKNOWLEDGE:
         raise RuntimeError("Expected acknowledge, got '{}'".format(response))
+    return int(os.environ[NOTIFY_FD_ENVIRONMENT_VARIABLE])
@@ -4,6 +4,9 @@
 # The argument to streamcanvas with which we start the plotter
 PLOTTER_ARGUMENT = '--plotter'
 
+# The environment variable that tells the plotter which file descriptor the gobbler will notify it on
+NOTIFY_FD_ENVIRONMENT_VARIABLE = 'STREAMCANVAS_NOTIFY_FD'
+
 
 # Signals that the plotter can pass to the gobbler
 SIGNAL_SEND_OPTIONS = 'a'                 # Give us the global options
@@ -11,6 +14,11 @@ SIGNAL_NEXT_FRAME = 'n'                   # Give us the next frame, complete or
 SIGNAL_MORE_OF_SAME_FRAME = 'm'           # Give us more of the frame that you previously gave us
 SIGNAL_ENTER_DROP_MODE = 'd'              # Allow yourself to drop frames
 SIGNAL_ENTER_NODROP_MODE = 'e'            # You must keep all the frames!
+SIGNAL_CATCH_UP = 'u'                     # Drop all but the most recent complete frame
+SIGNAL_USE_BINARY_PROTOCOL = 'b'          # Send everything after your acknowledgement with the binary protocol
+SIGNAL_USE_SHARED_MEMORY = 's'            # As binary, but send large payloads through shared memory
+SIGNAL_NOTIFY_ON_NEW_DATA = 'w'           # Write to the notification pipe whenever you have new data for us
+SIGNAL_SEND_COMPILED_FRAMES = 'k'         # Send frames compiled, rather than as text
 
 
 # Response codes that the gobbler can pass to the signaller
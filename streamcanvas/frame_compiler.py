@@ -0,0 +1,342 @@
+''' Compilation of frames into a compact typed form, which the plotter can draw without parsing any text '''
+
+import hashlib
+import re
+import struct
+
+from array import array
+from collections import OrderedDict
+
+from streamcanvas.constants import TOKEN_END_OF_FRAME
+from streamcanvas.tokenizer import join_tokens, tokenize_frame
+
+
+# The commands that we understand, and the opcode with which each is compiled. Any other command is ignored.
+COMMAND_TO_OPCODE = {'colour': 0,
+                     'rect': 1,
+                     'ellipse': 2,
+                     'circle': 3,
+                     'point': 4,
+                     'line': 5,
+                     'lineclosed': 6,
+                     'pen': 7,
+                     'break': 8,
+                     'update': 9,
+                     'delete': 10}
+OPCODE_TO_COMMAND = {opcode: command for command, opcode in COMMAND_TO_OPCODE.items()}
+
+# The commands whose first argument is a name rather than a number
+_NAMED_COMMANDS = ('pen', 'break')
+
+# A primitive may be given an id, as in circle@car7[0 0 1], in which case it is kept from one frame to the next until it
+# is changed with update@car7[...] or removed with delete@car7[]. The id is compiled as the command's name.
+_ID_SEPARATOR = '@'
+_BINARY_ID_SEPARATOR = _ID_SEPARATOR.encode('ascii')
+_RETAINABLE_COMMANDS = ('rect', 'ellipse', 'circle', 'point', 'line', 'lineclosed')
+_ID_COMMANDS = ('update', 'delete')
+
+# Hex colours are prefixed thus, and have an alpha byte only if they have this many digits
+_HEX_COLOUR_PREFIX = '0x'
+_HEX_DIGITS_WITH_ALPHA = 8
+
+# Encoded frames start with the number of commands, of numbers, and of bytes taken by the names. The numbers follow
+# straight after, where they are aligned for reading in place, then the other arrays and finally the names.
+_HEADER = struct.Struct('<QQQ')
+
+# Names are joined by a character that can't appear within them
+_NAME_SEPARATOR = '\0'
+
+# The size of the digest by which frames are identified. This is big enough that different frames never share one.
+_DIGEST_SIZE = 16
+
+# How many encoded frames are kept in a cache by default
+_DEFAULT_CACHE_SIZE = 8
+
+
+class CompiledFrame:
+    ''' A frame, or part of one, compiled into arrays that can be sent to the plotter as they are.
+
+        Each command has an opcode, and takes the numbers up to the corresponding entry of number_ends. A command that
+        takes a name (such as a pen, or the id of a retained object) gives its index in names, and every other command
+        has a name index of -1.
+    '''
+
+    def __init__(self):
+        self.opcodes = array('B')
+        self.number_ends = array('I')
+        self.name_indices = array('i')
+        self.numbers = array('d')
+        self.names = []
+        self._name_to_index = {}
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    def add_command(self, command, arguments):
+        ''' Add a command with the given arguments, which are strings. The command may be followed by an id. Commands
+            that we don't know, or whose arguments we don't understand, are ignored, since the gobbler mustn't be
+            brought down by a bad frame.
+        '''
+        command, _, object_id = command.partition(_ID_SEPARATOR)
+        opcode = COMMAND_TO_OPCODE.get(command)
+        if opcode is None:
+            return
+        name = None
+        if command in _NAMED_COMMANDS:
+            if len(arguments) == 0:
+                return
+            name = arguments[0]
+            arguments = arguments[1:]
+        elif command in _ID_COMMANDS:
+            if len(object_id) == 0:
+                return
+            name = object_id
+        elif command in _RETAINABLE_COMMANDS and len(object_id) > 0:
+            name = object_id
+        try:
+            numbers = _colour_numbers(arguments) if command == 'colour' else array('d', map(float, arguments))
+        except ValueError:
+            return
+
+        self.numbers.extend(numbers)
+        name_index = -1 if name is None else self._name_index(name)
+        self.opcodes.append(opcode)
+        self.number_ends.append(len(self.numbers))
+        self.name_indices.append(name_index)
+
+    def commands(self, numbers=None):
+        ''' Generate (command, name, numbers) for each command in turn, where name is None if the command takes none.
+            The numbers are sliced from the given sequence if there is one (e.g. a numpy view of self.numbers), and
+            from self.numbers otherwise.
+        '''
+        if numbers is None:
+            numbers = self.numbers
+        start = 0
+        for opcode, end, name_index in zip(self.opcodes, self.number_ends, self.name_indices):
+            name = None if name_index < 0 else self.names[name_index]
+            yield OPCODE_TO_COMMAND[opcode], name, numbers[start:end]
+            start = end
+
+    def encode(self):
+        ''' Return the frame as bytes '''
+        names = _NAME_SEPARATOR.join(self.names).encode('utf-8')
+        return b''.join((_HEADER.pack(len(self.opcodes), len(self.numbers), len(names)), self.numbers.tobytes(),
+                         self.number_ends.tobytes(), self.name_indices.tobytes(), self.opcodes.tobytes(), names))
+
+    @classmethod
+    def decode(cls, payload):
+        ''' Return the compiled frame encoded in the given bytes. Its arrays are read-only views of payload rather than
+            copies, so no more commands can be added to it.
+        '''
+        frame = cls()
+        payload = memoryview(payload)
+        num_commands, num_numbers, names_length = _HEADER.unpack_from(payload)
+        position = _HEADER.size
+        # The header is a multiple of 8 bytes long, so the numbers that follow it are aligned
+        for name, length in (('numbers', num_numbers), ('number_ends', num_commands),
+                             ('name_indices', num_commands), ('opcodes', num_commands)):
+            values = getattr(frame, name)
+            end = position + length * values.itemsize
+            setattr(frame, name, payload[position:end].cast(values.typecode))
+            position = end
+        if len(payload) != position + names_length:
+            raise RuntimeError('Compiled frame has the wrong length')
+        if names_length > 0:
+            frame.names = str(payload[position:], 'utf-8').split(_NAME_SEPARATOR)
+            frame._name_to_index = {name: index for index, name in enumerate(frame.names)}
+        return frame
+
+    def _name_index(self, name):
+        ''' Return the index of the given name, adding it if we haven't seen it before '''
+        index = self._name_to_index.get(name)
+        if index is None:
+            index = len(self.names)
+            self.names.append(name)
+            self._name_to_index[name] = index
+        return index
+
+
+def _colour_numbers(arguments):
+    ''' Return the numbers of a colour in normalized form, i.e. (red, green, blue, alpha) each between 0 and 1. The
+        colour is given either as a hex number such as 0xffff00, optionally followed by an alpha byte as in 0xffff0080,
+        or as up to four numbers between 0 and 1. Missing components are 0, except for alpha which is 1.
+
+        A colour without any arguments returns to the default pen, and has no numbers.
+    '''
+    if len(arguments) == 0:
+        return array('d')
+    if len(arguments) == 1 and arguments[0].lower().startswith(_HEX_COLOUR_PREFIX):
+        digits = arguments[0][len(_HEX_COLOUR_PREFIX):]
+        value = int(digits, 16)
+        if len(digits) < _HEX_DIGITS_WITH_ALPHA:
+            value = value << 8 | 0xff
+        return array('d', ((value >> shift & 0xff) / 255 for shift in (24, 16, 8, 0)))
+
+    # Anything out of range (or not a number at all) is clamped
+    components = [0.0 if not component > 0 else min(component, 1.0) for component in map(float, arguments[:4])]
+    components += [0.0] * (3 - len(components))
+    if len(components) == 3:
+        components.append(1.0)
+    return array('d', components)
+
+
+class FrameCompiler:
+    ''' Compile the text of a frame into a CompiledFrame. The text may be given in parts, each of which must consist of
+        whole tokens. A command whose arguments are yet to arrive is remembered until the next part.
+    '''
+
+    def __init__(self):
+        self._pending_command = None
+
+    def compile(self, text, new_frame=True):
+        ''' Compile the next part of a frame, or the start of a new frame if new_frame is True '''
+        if new_frame:
+            self._pending_command = None
+        frame = CompiledFrame()
+        for command, arguments in self._command_and_argument_pairs(text):
+            frame.add_command(command, arguments)
+        return frame
+
+    def _command_and_argument_pairs(self, text):
+        ''' Split the text into pairs and yield in the form of (command, arguments). For example:
+
+            circle[0 0 1]   --> ('circle', ['0', '0', '1'])
+            reset_pen[]     --> ('reset_pen', [])
+
+            We don't support commands without arguments, e.g. "reset_pen", since this creates ambiguity when we have
+            a partial frame -- we could return ('circle', None), and we don't want the caller to have to deal with this
+            case for every command.
+        '''
+        # Split at spaces (outside of brackets) or at brackets themselves
+        # TODO removing newlines completely may not be desired, we could perhaps do better
+        text = text.replace('\n', ' ')
+        tokens = [token for token in re.split(r"( |\[.*?\])", text) if token.strip()]
+
+        for token in tokens:
+            # If command would be an end of frame, we should definitely stop. If the arguments would be an end of
+            # frame we ignore the command, since we expect every command to have some arguments
+            if token == TOKEN_END_OF_FRAME:
+                self._pending_command = None
+                break
+
+            if self._pending_command is None:
+                # We need a new command
+                self._pending_command = token
+                continue
+
+            token = token.lstrip('[').rstrip(']')
+            if '"' in token or "'" in token:
+                arguments = [piece for piece in re.split(r"( |\".*?\"|'.*?')", token) if piece.strip()]
+            else:
+                # Without any quotes to respect, a long block of coordinates can be split in one go
+                arguments = token.split()
+            command = self._pending_command
+            self._pending_command = None
+            yield command, arguments
+
+
+def compile_frame(text):
+    ''' Return the compiled form of the given text, which must contain a whole frame '''
+    return FrameCompiler().compile(text)
+
+
+def frame_digest(data):
+    ''' Return a digest of the given frame, which may be given as text or as bytes '''
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return hashlib.blake2b(data, digest_size=_DIGEST_SIZE).digest()
+
+
+class EncodedFrameCache:
+    ''' The encoded compiled forms of the most recently seen complete frames, keyed by the digest of their text. A
+        producer that sends the same frame over and over then only needs it compiled once.
+    '''
+
+    def __init__(self, size=_DEFAULT_CACHE_SIZE):
+        self.size = size
+        self._digest_to_encoded = OrderedDict()
+
+    def encode(self, text):
+        ''' Return the encoded compiled form of the given text, which must contain a whole frame '''
+        digest = frame_digest(text)
+        encoded = self._digest_to_encoded.get(digest)
+        if encoded is None:
+            encoded = compile_frame(text).encode()
+            self._digest_to_encoded[digest] = encoded
+            if len(self._digest_to_encoded) > self.size:
+                self._digest_to_encoded.popitem(last=False)
+        else:
+            self._digest_to_encoded.move_to_end(digest)
+        return encoded
+
+
+def _command_token(command, object_id, arguments):
+    ''' Return the token of a command, which may have an id, with the given arguments '''
+    if len(object_id) > 0:
+        command += _ID_SEPARATOR + object_id
+    return '{}[{}]'.format(command, ' '.join(arguments))
+
+
+class DroppedSceneEdits:
+    ''' The changes to the retained scene made by frames that are dropped, folded together so that they can be sent at
+        the start of the next frame that isn't. Otherwise an object moved or deleted in a dropped frame would stay as it
+        was.
+
+        For each id we keep only the last primitive, update or delete given for it, and fold an update into a primitive
+        that we have. A primitive is kept along with the colour that it is drawn in.
+    '''
+
+    def __init__(self):
+        # Each id maps to (colour, command, arguments), where colour is the arguments of the colour in which a primitive
+        # is drawn, or None if its frame gave no colour
+        self._id_to_edit = OrderedDict()
+
+    def __len__(self):
+        return len(self._id_to_edit)
+
+    def add_frame(self, text, start=0, end=None):
+        ''' Fold in the changes made by a dropped frame, given as text or UTF-8 encoded bytes that needn't have been
+            tokenized. If start or end are given, the frame is only that part of the text.
+        '''
+        if end is None:
+            end = len(text)
+        # Few streams use ids at all, and we needn't look any further at a frame that has none
+        binary = not isinstance(text, str)
+        if text.find(_BINARY_ID_SEPARATOR if binary else _ID_SEPARATOR, start, end) == -1:
+            return
+        text = text[start:end]
+        if binary:
+            text = text.decode('utf-8')
+
+        colour = None
+        for command, arguments in FrameCompiler()._command_and_argument_pairs(tokenize_frame(text)):
+            command, _, object_id = command.partition(_ID_SEPARATOR)
+            if command == 'colour':
+                colour = arguments if len(arguments) > 0 else None
+            elif len(object_id) == 0:
+                continue
+            elif command in _RETAINABLE_COMMANDS:
+                self._id_to_edit[object_id] = (colour, command, arguments)
+            elif command == 'update':
+                old_colour, old_command, _ = self._id_to_edit.get(object_id, (None, 'update', None))
+                # An object that has been deleted stays deleted
+                if old_command != 'delete':
+                    self._id_to_edit[object_id] = (old_colour, old_command, arguments)
+            elif command == 'delete':
+                self._id_to_edit[object_id] = (None, command, arguments)
+
+    def take(self):
+        ''' Return the folded changes as tokens to go at the start of the next frame that is sent, and forget them. Any
+            colours that they set are undone at the end, so the frame itself is drawn just as it would be without them.
+        '''
+        tokens = []
+        current_colour = None
+        for object_id, (colour, command, arguments) in self._id_to_edit.items():
+            if colour != current_colour:
+                tokens.append(_command_token('colour', '', colour or []))
+                current_colour = colour
+            tokens.append(_command_token(command, object_id, arguments))
+        if current_colour is not None:
+            tokens.append(_command_token('colour', '', []))
+        self._id_to_edit.clear()
+        return join_tokens(tokens)
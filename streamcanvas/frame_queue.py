@@ -0,0 +1,106 @@
+''' A queue of complete frames that keeps within a memory budget by spilling frames to disk '''
+
+import mmap
+import tempfile
+
+from collections import deque
+
+
+class FrameQueue:
+    ''' A first-in first-out queue of complete frames, each of which is a string.
+
+        Frames are kept in memory until they use more than memory_budget characters between them. Any further frames
+        are appended to a temporary file, and we keep only their offset and length. When such a frame reaches the front
+        of the queue it is read back from a memory map of the file. Once no frames remain on disk, the file is emptied
+        so that it can be reused.
+    '''
+
+    def __init__(self, memory_budget):
+        self.memory_budget = memory_budget
+
+        # Each entry is either a frame string, or an (offset, length) pair locating a frame in the spill file
+        self._entries = deque()
+        self._memory_used = 0
+
+        self._spill_file = None
+        self._spill_map = None
+        self._spill_size = 0
+        self._num_spilled = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        for entry in self._entries:
+            yield self._frame_from_entry(entry)
+
+    def append(self, frame):
+        ''' Add a frame to the back of the queue '''
+        if self._memory_used + len(frame) <= self.memory_budget:
+            self._entries.append(frame)
+            self._memory_used += len(frame)
+        else:
+            self._entries.append(self._spill(frame))
+            self._num_spilled += 1
+
+    def popleft(self):
+        ''' Remove and return the frame at the front of the queue '''
+        entry = self._entries.popleft()
+        frame = self._frame_from_entry(entry)
+        if isinstance(entry, str):
+            self._memory_used -= len(frame)
+        else:
+            self._num_spilled -= 1
+            if self._num_spilled == 0:
+                self._empty_spill_file()
+        return frame
+
+    def clear(self):
+        ''' Remove all frames '''
+        self._entries.clear()
+        self._memory_used = 0
+        self._num_spilled = 0
+        self._empty_spill_file()
+
+    def keep_last(self):
+        ''' Discard all frames except the one at the back of the queue '''
+        if len(self._entries) <= 1:
+            return
+        frame = self._frame_from_entry(self._entries[-1])
+        self.clear()
+        self.append(frame)
+
+    def _spill(self, frame):
+        ''' Append the frame to the spill file, and return its offset and length there '''
+        if self._spill_file is None:
+            # Writes must be unbuffered, so that they are visible through the memory map
+            self._spill_file = tempfile.TemporaryFile(buffering=0)
+        data = frame.encode('utf-8')
+        offset = self._spill_size
+        self._spill_file.write(data)
+        self._spill_size += len(data)
+        return offset, len(data)
+
+    def _frame_from_entry(self, entry):
+        ''' Return the frame for the given entry, reading it from disk if necessary '''
+        if isinstance(entry, str):
+            return entry
+        offset, length = entry
+        if length == 0:
+            return ''
+        # The file may have grown since we last mapped it
+        if self._spill_map is None or offset + length > len(self._spill_map):
+            if self._spill_map is not None:
+                self._spill_map.close()
+            self._spill_map = mmap.mmap(self._spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._spill_map[offset:offset + length].decode('utf-8')
+
+    def _empty_spill_file(self):
+        ''' Throw away the contents of the spill file, which must no longer be needed '''
+        if self._spill_map is not None:
+            self._spill_map.close()
+            self._spill_map = None
+        if self._spill_file is not None:
+            self._spill_file.truncate(0)
+            self._spill_file.seek(0)
+        self._spill_size = 0
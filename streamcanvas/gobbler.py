@@ -1,18 +1,53 @@
 ''' Asyncio-based gobbler of stdin, which will start a plotter and deliver frames to it as requested '''
 
 import asyncio
+import codecs
+import fcntl
+import mmap
+import os
+import queue
 import sys
+import threading
 import time
 
+from array import array
 from asyncio import coroutine
 from enum import Enum
+from itertools import islice
 
-from streamcanvas.communication import send_response_and_data
+from streamcanvas.communication import FRAME_RESPONSES, SharedMemorySender, send_response_and_data
 from streamcanvas.constants import *
-from streamcanvas.options import OPTIONS
+from streamcanvas.frame_compiler import DroppedSceneEdits, EncodedFrameCache, FrameCompiler
+from streamcanvas.frame_queue import FrameQueue
+from streamcanvas.options import OPTIONS, Protocol
+from streamcanvas.tokenizer import FrameScanner, Tokenizer, join_tokens, tokenize_frame
 from streamcanvas.utils import sc_print
 
 
+class DurationStatistics:
+    ''' Keep track of how long something takes, so that we can report on the worst case '''
+
+    def __init__(self, description):
+        self._description = description
+        self._count = 0
+        self._total = 0.0
+        self._maximum = 0.0
+
+    def add(self, duration):
+        ''' Record a single duration, in seconds '''
+        self._count += 1
+        self._total += duration
+        self._maximum = max(self._maximum, duration)
+
+    def __str__(self):
+        mean = self._total / self._count if self._count > 0 else 0.0
+        return '{}: max {:.3f} ms, mean {:.3f} ms over {}'.format(self._description, 1000 * self._maximum,
+                                                                    1000 * mean, self._count)
+
+# How long it takes us to respond to each signal from the plotter
+_RESPONSE_TIMES = DurationStatistics('Response time to the plotter')
+
+
 class OptionsStore:
     ''' Store the global options that should be passed along to the plotter '''
 
@@ -61,6 +96,12 @@ class OptionsStore:
         '''
         self._options_ready = True
 
+    def apply(self):
+        ''' Apply the options to our own copy of OPTIONS, so that those which concern us take effect here as well as in
+            the plotter
+        '''
+        OPTIONS.apply_data(self._data, log=False)
+
     def get_response_and_data(self):
         ''' If ready, return the options as a string along with appropriate response, otherwise indicate that they
             are not ready by specifying RESPONSE_OPTIONS_NOT_READY
@@ -72,19 +113,32 @@ class OptionsStore:
 _OPTIONS_STORE = OptionsStore()
 
 
+# Until we are told otherwise, keep this many characters of complete frames in memory
+_DEFAULT_FRAME_MEMORY_BUDGET = OPTIONS.frame_memory_mb * (1 << 20)
+
+
 class FrameStore:
     ''' A store for one or multiple frames, which can be specified.
 
         If store_all_frames is False, then we store two frames - one that is complete, and one that is being filled.
-        Frames are stored as strings of tokens, separated by a space. store_all_frames can be changed at runtime, and
-        will alter subsequent behaviour of end_frame().
+        Complete frames are stored as strings of tokens, separated by a space, in a FrameQueue, which spills them to
+        disk beyond its memory budget. The frame in progress is a list of tokens, which is only joined when it is
+        needed. store_all_frames can be changed at runtime, and will
+        alter subsequent behaviour of end_frame().
+
+        Once we are allowed to drop frames we stop tokenizing them as they arrive, since most will never be looked at.
+        Instead we scan the raw text for the ends of frames, keeping only the raw text of the most recent complete frame
+        and of the frame in progress. Frames are then tokenized only when the plotter asks for them.
+
+        The changes that dropped frames make to the retained scene are not dropped with them, but are sent at the start
+        of the next frame that is delivered.
     '''
 
     def __init__(self):
         # We start out by storing all frames, and will then be told later by the plotter whether we can start dropping
-        self.store_all_frames = True
-        self.complete_frames = []
-        self.frame_in_progress = ''
+        self._store_all_frames = True
+        self.complete_frames = FrameQueue(_DEFAULT_FRAME_MEMORY_BUDGET)
+        self.frame_in_progress = []
 
         # Indicates that we have delivered part of a frame, but not all of it
         self._part_way_through_delivering_frame = False
@@ -96,27 +150,162 @@ class FrameStore:
         # This will hold the remainder of a frame that is part way through being given
         self._remainder_of_partial_frame = ''
 
+        # Tokens for frame_in_progress come from here. When scanning, it is only given text when it is needed.
+        self._tokenizer = Tokenizer(self.add_token)
+
+        # When scanning, this finds the ends of frames. If it is None we tokenize all text as it arrives.
+        self._scanner = None
+
+        # Raw text of the frame in progress that we haven't yet given to the tokenizer, the scanner offset at which it
+        # starts, and whether any of this frame has been given to the tokenizer already
+        self._raw_tail = []
+        self._raw_tail_offset = 0
+        self._raw_tail_partly_tokenized = False
+
+        # Set once there is no more input to come
+        self._input_finished = False
+
+        # The changes to the retained scene made by frames that we have dropped
+        self._dropped_edits = DroppedSceneEdits()
+
+    @property
+    def store_all_frames(self):
+        ''' Whether we must keep every frame, rather than just the most recent complete one '''
+        return self._store_all_frames
+
+    @store_all_frames.setter
+    def store_all_frames(self, store_all_frames):
+        self._store_all_frames = store_all_frames
+        # We start scanning at the next end of frame, but must stop immediately, since we need every frame again
+        if store_all_frames and self._scanner is not None:
+            self._stop_scanning()
+
+    def add_text(self, text):
+        ''' Add raw text from the input stream '''
+        while len(text) > 0:
+            if self._scanner is not None:
+                self._add_raw_text(text)
+                return
+            # The tokenizer stops early if we switch to scanning
+            text = text[self._tokenizer.feed(text):]
+
+    def finish(self):
+        ''' Indicate that there is no more input to come '''
+        self._input_finished = True
+        if self._scanner is None:
+            self._tokenizer.finish()
+            return
+
+        frame_ends = self._scanner.finish()
+        if len(frame_ends) > 0:
+            self._end_raw_frames(frame_ends)
+
     def add_token(self, token):
-        ''' Add a token to the current frame '''
-        self.frame_in_progress += ' ' + token
+        ''' Add a token to the current frame. Return True if we have just switched to scanning, and so don't want
+            any more tokens.
+        '''
+        self.frame_in_progress.append(token)
         if token == TOKEN_END_OF_FRAME:
-            self._end_frame()
+            return self._end_frame()
+        return False
 
     def _end_frame(self):
-        ''' Indicate that any tokens arriving after this point belong to a new frame '''
+        ''' Indicate that any tokens arriving after this point belong to a new frame. Return True if we have just
+            switched to scanning.
+        '''
         # If we're part-way through a partial frame, update things appropriately. We don't touch complete_frames
         # in this case.
         if self._still_receiving_data_for_partial_frame:
-            self._remainder_of_partial_frame = self.frame_in_progress
-            self.frame_in_progress = ''
+            self._remainder_of_partial_frame = join_tokens(self.frame_in_progress)
+            self.frame_in_progress = []
             self._still_receiving_data_for_partial_frame = False
-            return
+            return False
 
         # Drop the old complete frames if necessary
         if not self.store_all_frames:
-            del self.complete_frames[:]
-        self.complete_frames.append(self.frame_in_progress)
-        self.frame_in_progress = ''
+            for frame in self.complete_frames:
+                self._dropped_edits.add_frame(frame)
+            self.complete_frames.clear()
+        self.complete_frames.append(join_tokens(self.frame_in_progress))
+        self.frame_in_progress = []
+
+        # If we're now allowed to drop frames, this is the point at which to start scanning
+        if not self.store_all_frames and self._scanner is None:
+            self._scanner = FrameScanner()
+            self._raw_tail_offset = 0
+            return True
+        return False
+
+    def _add_raw_text(self, text):
+        ''' Scan the given text for the ends of frames, and keep it as raw text '''
+        self._raw_tail.append(text)
+        frame_ends = self._scanner.scan(text)
+        if len(frame_ends) > 0:
+            self._end_raw_frames(frame_ends)
+
+    def _end_raw_frames(self, frame_ends):
+        ''' Deal with the frames that the scanner tells us have ended in the raw text '''
+        raw_tail = ''.join(self._raw_tail)
+        frame_ends = [frame_end - self._raw_tail_offset for frame_end in frame_ends]
+
+        # If we have started to tokenize the frame in progress, which happens if we've delivered part of it, then we
+        # must finish tokenizing it. Otherwise we'd lose what the tokenizer already has.
+        frame_start = 0
+        if self._raw_tail_partly_tokenized:
+            self._tokenizer.feed(raw_tail[:frame_ends[0]])
+            self._tokenizer.finish()
+            frame_start = frame_ends.pop(0)
+
+        # Only the most recent complete frame is kept; everything before it is dropped without being tokenized, unless
+        # it changes the retained scene
+        if len(frame_ends) > 0:
+            for frame in self.complete_frames:
+                self._dropped_edits.add_frame(frame)
+            for frame_end in frame_ends[:-1]:
+                self._dropped_edits.add_frame(raw_tail, frame_start, frame_end)
+                frame_start = frame_end
+            self.complete_frames.clear()
+            self.complete_frames.append(raw_tail[frame_start:frame_ends[-1]])
+            frame_start = frame_ends[-1]
+
+        self._raw_tail = [raw_tail[frame_start:]]
+        self._raw_tail_offset += frame_start
+        self._raw_tail_partly_tokenized = False
+        self.frame_in_progress = []
+
+    def _tokenize_raw_tail(self):
+        ''' Tokenize what we have of the raw frame in progress, so that it ends up in frame_in_progress '''
+        raw_tail = ''.join(self._raw_tail)
+        self._raw_tail = []
+        self._raw_tail_offset += len(raw_tail)
+        self._raw_tail_partly_tokenized = True
+        self._tokenizer.feed(raw_tail)
+        if self._input_finished:
+            self._tokenizer.finish()
+
+    def _stop_scanning(self):
+        ''' Tokenize the raw frames that we have, and go back to tokenizing all text as it arrives '''
+        raw_frames = list(self.complete_frames)
+        self.complete_frames.clear()
+        for frame in raw_frames:
+            self.complete_frames.append(tokenize_frame(frame))
+        self._tokenize_raw_tail()
+        self._scanner = None
+        self._raw_tail_partly_tokenized = False
+
+    def catch_up(self):
+        ''' Discard every complete frame except the most recent one, so that it is the next to be delivered '''
+        for frame in islice(self.complete_frames, len(self.complete_frames) - 1):
+            self._dropped_edits.add_frame(frame)
+        self.complete_frames.keep_last()
+
+    def has_complete_frame(self):
+        ''' Return True iff there is a complete frame waiting to be delivered '''
+        return len(self.complete_frames) > 0
+
+    def set_memory_budget(self, memory_budget):
+        ''' Set the number of characters of complete frames that we may keep in memory before spilling to disk '''
+        self.complete_frames.memory_budget = memory_budget
 
     def get_response_and_data(self, signal):
         ''' Given the current state of the store, when more data is requested calculate what response we should give,
@@ -128,9 +317,11 @@ class FrameStore:
                 raise RuntimeError("We are asked to deliver more of a frame, but we haven't given one!")
 
             if self._still_receiving_data_for_partial_frame:
+                if self._scanner is not None:
+                    self._tokenize_raw_tail()
                 response = RESPONSE_CONTINUE_PARTIAL_FRAME
-                data = self.frame_in_progress
-                self.frame_in_progress = ''
+                data = join_tokens(self.frame_in_progress)
+                self.frame_in_progress = []
             else:
                 # This is the last segment of the frame, we are done delivering this frame
                 response = RESPONSE_END_PARTIAL_FRAME
@@ -142,24 +333,30 @@ class FrameStore:
         # available.
 
         elif len(self.complete_frames) > 0:
-            # If we have a complete frame, then send that, and remove from the pending list
+            # If we have a complete frame, then send that, and remove from the pending list. When scanning, this is
+            # the point at which it is tokenized.
             response = RESPONSE_COMPLETE_FRAME
-            data = self.complete_frames[0]
-            del self.complete_frames[0]
+            data = self.complete_frames.popleft()
+            if self._scanner is not None:
+                data = tokenize_frame(data)
+            data = self._dropped_edits.take() + data
             # If we were part way through delivering a frame, that's no longer the case
             self._part_way_through_delivering_frame = False
 
         else:
             # ... but if we don't have a complete frame, then send what we currently have of the next frame.
+            if self._scanner is not None:
+                self._tokenize_raw_tail()
 
             # TODO - there's an edge case here. We can return a new partial frame, then get asked for a *new* frame,
             # but in fact return a further part of the same partial frame
-            data = self.frame_in_progress
+            data = join_tokens(self.frame_in_progress)
             if len(data) == 0:
                 response = RESPONSE_NO_NEXT_FRAME
             else:
                 response = RESPONSE_BEGIN_PARTIAL_FRAME
-                self.frame_in_progress = ''
+                data = self._dropped_edits.take() + data
+                self.frame_in_progress = []
                 self._part_way_through_delivering_frame = True
                 self._still_receiving_data_for_partial_frame = True
         return response, data
@@ -168,18 +365,131 @@ class FrameStore:
 _FRAME_STORE = FrameStore()
 
 
+class FileFrameStore:
+    ''' A store that serves the frames of a regular file given with --input, rather than reading stdin.
+
+        We map the file into memory and find the offset at which every frame starts with a single scan. Any frame can
+        then be served directly from the map, and is tokenized only when delivered. Since the file already exists in
+        full, every frame is complete; in drop mode we jump straight to the last one.
+    '''
+
+    def __init__(self, path):
+        self.store_all_frames = True
+        self._next_frame = 0
+        self._dropped_edits = DroppedSceneEdits()
+
+        with open(path, 'rb') as file_:
+            # We can't map an empty file, but it has no frames anyway
+            if os.fstat(file_.fileno()).st_size == 0:
+                self._map = b''
+            else:
+                self._map = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+
+        frames_start = self._read_options()
+        self._frame_starts = self._index_frames(frames_start)
+
+    def _read_options(self):
+        ''' Pass any options block at the start of the file to the options store, and return the offset at which the
+            frames start
+        '''
+        tokens = []
+        def add_token(token):
+            tokens.append(token)
+            # Stop as soon as we know that we're not in an options block, or we've reached its end
+            return tokens[0] != TOKEN_START_OPTIONS or token == TOKEN_END_OPTIONS
+
+        tokenizer = Tokenizer(add_token)
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        text = ''
+        for chunk_start in range(0, len(self._map), _READ_CHUNK_SIZE):
+            chunk = decoder.decode(self._map[chunk_start:chunk_start + _READ_CHUNK_SIZE])
+            num_consumed = tokenizer.feed(chunk)
+            text += chunk[:num_consumed]
+            if num_consumed < len(chunk):
+                break
+
+        if len(tokens) == 0 or tokens[0] != TOKEN_START_OPTIONS:
+            _OPTIONS_STORE.no_options_tokens_coming()
+            return 0
+        for token in tokens:
+            _OPTIONS_STORE.add_token(token)
+        return len(text.encode('utf-8'))
+
+    def _index_frames(self, frames_start):
+        ''' Return an array of the offsets at which each frame starts, with the end of the last frame appended '''
+        scanner = FrameScanner(binary=True)
+        frame_starts = array('q', (frames_start,))
+        for chunk_start in range(frames_start, len(self._map), _INDEX_CHUNK_SIZE):
+            frame_ends = scanner.scan(self._map[chunk_start:chunk_start + _INDEX_CHUNK_SIZE])
+            frame_starts.extend(frames_start + frame_end for frame_end in frame_ends)
+        frame_starts.extend(frames_start + frame_end for frame_end in scanner.finish())
+
+        # Anything after the last end-of-frame token is a final frame, unless it's just whitespace and comments
+        if len(self._frame(frame_starts[-1], len(self._map))) > 0:
+            frame_starts.append(len(self._map))
+        return frame_starts
+
+    def _frame(self, start, end):
+        ''' Return the frame between the given offsets as a string of tokens '''
+        return tokenize_frame(self._map[start:end].decode('utf-8'))
+
+    def catch_up(self):
+        ''' Skip to the last frame in the file, keeping the changes to the retained scene made by those we skip '''
+        last_frame = max(self._next_frame, len(self._frame_starts) - 2)
+        for frame in range(self._next_frame, last_frame):
+            self._dropped_edits.add_frame(self._map, self._frame_starts[frame], self._frame_starts[frame + 1])
+        self._next_frame = last_frame
+
+    def has_complete_frame(self):
+        ''' Return True iff there is a frame in the file that we are yet to deliver '''
+        return self._next_frame < len(self._frame_starts) - 1
+
+    def get_response_and_data(self, signal):
+        ''' Return the response to give and data to send to the plotter, in the same way as FrameStore '''
+        if signal == SIGNAL_MORE_OF_SAME_FRAME:
+            raise RuntimeError("We are asked to deliver more of a frame, but we only deliver complete frames!")
+
+        if not self.store_all_frames:
+            self.catch_up()
+        if self._next_frame >= len(self._frame_starts) - 1:
+            return RESPONSE_NO_NEXT_FRAME, ''
+
+        start, end = self._frame_starts[self._next_frame], self._frame_starts[self._next_frame + 1]
+        self._next_frame += 1
+        return RESPONSE_COMPLETE_FRAME, self._dropped_edits.take() + self._frame(start, end)
+
+
 class StoreSelector:
-    ''' Send tokens either to the options store or the frame store, as appropriate '''
+    ''' Send tokens either to the options store or the frame store, as appropriate. We tokenize the input ourselves
+        only until the options are done, after which raw text is passed straight on to the frame store.
+    '''
 
     def __init__(self):
         self._just_started = True
         self._in_options = False
+        self._options_done = False
+        self._tokenizer = Tokenizer(self.add_token)
+
+    def add_text(self, text):
+        ''' Add raw text from the input stream '''
+        if not self._options_done:
+            num_consumed = self._tokenizer.feed(text)
+            text = text[num_consumed:]
+        if self._options_done:
+            _FRAME_STORE.add_text(text)
+
+    def finish(self):
+        ''' Indicate that there is no more input to come '''
+        if self._options_done:
+            _FRAME_STORE.finish()
+        else:
+            self._tokenizer.finish()
 
     def add_token(self, token):
-        ''' Add a token to the appropriate store '''
+        ''' Add a token to the appropriate store. Return True once we have no further need for tokens. '''
         # Don't do anything with empty tokens
         if len(token) == 0:
-            return
+            return False
 
         # If this is the first token we absorb, see if it is an instruction to start options. If it is then start
         # options, otherwise signal to the options store not to expect any
@@ -192,169 +502,314 @@ class StoreSelector:
 
         if self._in_options:
             _OPTIONS_STORE.add_token(token)
-            # If this is the last options token, come out of options mode
+            # If this is the last options token, come out of options mode, and take on any options that concern the
+            # frame store
             if token == TOKEN_END_OPTIONS:
                 self._in_options = False
+                self._options_done = True
+                _OPTIONS_STORE.apply()
+                _FRAME_STORE.set_memory_budget(OPTIONS.frame_memory_mb * (1 << 20))
         else:
             _FRAME_STORE.add_token(token)
+            self._options_done = True
+        return self._options_done
 
 
 _STORE_SELECTOR = StoreSelector()
 
+# The stores may be filled on a thread that reads stdin, while the event loop takes frames from them, so each holds this
+# while using them
+_STORE_LOCK = threading.Lock()
 
-# Constants that we cache for performance
-# Separators of tokens
-_SEPARATORS = (' ', '\n', '\t')
 
-# We ignore everything that is within a comment.
-_COMMENT_START = '#'
-_COMMENT_END = '\n'
+# The most that we will take from stdin in a single read
+_READ_CHUNK_SIZE = 1 << 16
 
-# When we're within a delimiter pair we keep absorbing the token
-_OPENING_TO_CLOSING_DELIMITER = {'(': ')', '[': ']', '{': '}', '"': '"', "'": "'"}
-_CLOSING_DELIMITERS = set(_OPENING_TO_CLOSING_DELIMITER.values())
-_STRING_DELIMITERS = ('"', "'")
+# When indexing a file, we scan it in chunks of this many bytes
+_INDEX_CHUNK_SIZE = 1 << 24
 
+# The number of reads we'll make before giving the event loop a chance to service the plotter
+_MAX_READS_PER_CALLBACK = 16
 
-def _closing_string(buf, delimiter_stack, character):
-    ''' Return True iff we are in a string, and the character is about to close it '''
-    if len(delimiter_stack) == 0:
-        return False
-    delimiter = delimiter_stack[-1]
-    return delimiter in _STRING_DELIMITERS and (character == delimiter)
+# Decode stdin incrementally, since a multi-byte character may be split over two reads
+_STDIN_DECODER = codecs.getincrementaldecoder('utf-8')()
 
 
-def _in_string(buf, delimiter_stack, character):
-    ''' Return True iff we're currently in the middle of a string constant that we're not about to close with
-        character. We make the assumption that you close the string with the same type of quote with which it was
-        opened.
-    '''
-    if len(delimiter_stack) == 0:
-        return False
-    delimiter = delimiter_stack[-1]
-    return delimiter in _STRING_DELIMITERS and not (character == delimiter)
+def _set_non_blocking(fd):
+    ''' Ensure that reads from the given file descriptor return immediately with whatever is available '''
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
 
-def read_frames(loop):
-    ''' Read characters from standard in until we have a complete word, i.e. received a recognised separator token
-        after a string of characters. Ensure we keep at least the latest of these tokens.
+class PlotterNotifier:
+    ''' Tells the plotter that we have new data for it, by writing to a pipe of its own. Since this is separate from
+        the pipe on which we respond, a notification can never get mixed up with a response.
+
+        We only notify once the plotter has asked us to, and then at most once until it next asks for data, so a quiet
+        plotter is never woken more than once however much data arrives. If it asks for data while we have more complete
+        frames than it takes, we notify it again straight away, since no new data may arrive to do so.
     '''
-    # For clarity, we keep state information about being in comments separate from the delimiter pair stack.
-    in_comment = False
 
-    # Whenever we see an opening delimiter, we pop it onto the stack.
-    delimiter_stack = []
+    def __init__(self):
+        self.fd = None
+        self.enabled = False
+        self._pending = False
 
-    buf = ''
-    # The infinite loop is manually broken when we've read a whole token.
-    while True:
-        character = sys.stdin.read(1)
-
-        # We have reached the end of the file when we get the empty string. We won't exit as we will still
-        # keep the plotter alive once the input stream finishes. We wait to be killed.
-        if character == '':
-            # TODO, we could just add this to the separator list and handle it in the same way? See if we need
-            # the knowledge that we're done anywhere else.
-            _STORE_SELECTOR.add_token(buf)
+    def notify(self):
+        ''' Tell the plotter that there is new data, unless it has already been told '''
+        if not self.enabled or self._pending or self.fd is None:
             return
+        self._pending = True
+        try:
+            os.write(self.fd, b'!')
+        except BlockingIOError:
+            # The pipe is full of notifications already, so the plotter can hardly miss this one
+            pass
 
-        # If we're in a comment, and we see the end-of-comment indicator, we're done. The next pass will start
-        # on the new token.
-        elif in_comment and character == _COMMENT_END:
-            return
+    def data_requested(self, more_to_come=False):
+        ''' Note that the plotter has just been given data. If more_to_come is True we still have complete frames for
+            it, so we tell it so.
+        '''
+        self._pending = False
+        if more_to_come:
+            self.notify()
 
-        # If we're in a comment and we see any other character, ignore it
-        elif in_comment:
-            continue
 
-        # If we're within a string delimiter that we're not closing then we are happy to absorb any old rubbish
-        elif _in_string(buf, delimiter_stack, character):
-            pass
+_PLOTTER_NOTIFIER = PlotterNotifier()
 
-        # We're not in a comment, and we're not in a string. If we see the comment start indicator we start a comment.
-        # Since each infinite loop is intended to capture one token we *must* ensure that we break upon finishing a
-        # comment.
-        elif character == _COMMENT_START:
-            _STORE_SELECTOR.add_token(buf)
-            in_comment = True
-            continue
-
-        # We have an opening separator! We push it onto the delimiter stack, but also let it be added to the buffer
-        # Note that we need to ensure that we're not closing a string at this point. If closing a string we want
-        # to fall through to the logic below
-        elif character in _OPENING_TO_CLOSING_DELIMITER and not _closing_string(buf, delimiter_stack, character):
-            delimiter_stack.append(character)
-
-        # We have a closing separator!
-        elif character in _CLOSING_DELIMITERS:
-            if len(delimiter_stack) == 0 or _OPENING_TO_CLOSING_DELIMITER[delimiter_stack[-1]] != character:
-                raise RuntimeError("Unmatched closing delimiter {} in '{}'".format(character, buf))
-            # We know this is the correct delimiter, so pop it off the stack
-            delimiter_stack.pop()
-
-        # We have a separator, and we're not within a comment or delimiter! Flush the complete token and finish.
-        elif character in _SEPARATORS and len(delimiter_stack) == 0:
-            _STORE_SELECTOR.add_token(buf)
-            return
 
-        # Append the character to the buffer
-        buf += character
+def read_frames(loop):
+    ''' Drain whatever is currently available on stdin with large non-blocking reads, and pass on every token that is
+        completed therein. Comment, string and delimiter state is carried over from one chunk to the next.
+    '''
+    fd = sys.stdin.fileno()
+    for _ in range(_MAX_READS_PER_CALLBACK):
+        try:
+            data = os.read(fd, _READ_CHUNK_SIZE)
+        except BlockingIOError:
+            # We've taken everything that is available for now
+            break
+
+        # We have reached the end of the file when we get no data. We won't exit as we will still keep the plotter
+        # alive once the input stream finishes; we wait to be killed. We do stop watching stdin though, since it
+        # would otherwise be reported as readable forever.
+        if len(data) == 0:
+            _STORE_SELECTOR.add_text(_STDIN_DECODER.decode(b'', final=True))
+            _STORE_SELECTOR.finish()
+            loop.remove_reader(fd)
+            break
+
+        _STORE_SELECTOR.add_text(_STDIN_DECODER.decode(data))
+
+    _PLOTTER_NOTIFIER.notify()
+
+
+class IngestionThread(threading.Thread):
+    ''' Read stdin on a thread of its own into a preallocated ring of buffers, so that the producer never waits on
+        the event loop, and the event loop never waits on the producer.
+
+        A second thread takes each filled buffer in turn and passes its text on to the stores, where it is scanned or
+        tokenized, so the event loop only has to take frames that are already finished. The stores are shared with the
+        event loop, so we hold _STORE_LOCK while passing on each buffer. The event loop therefore never waits for
+        longer than it takes to deal with a single buffer before it can respond to the plotter.
+
+        The ring has a fixed number of buffers. We only wait for one to be freed if every buffer is still waiting to be
+        scanned, which is the only time that we exert back-pressure on the producer. How often this happens and for
+        how long is recorded, along with the time between reads.
+    '''
+
+    def __init__(self, loop, num_buffers):
+        super().__init__(daemon=True)
+        self._loop = loop
+        self._fd = sys.stdin.fileno()
+        self._free_buffers = queue.Queue()
+        for _ in range(num_buffers):
+            self._free_buffers.put(bytearray(_READ_CHUNK_SIZE))
+        # Each filled buffer comes with the number of bytes read into it, and None follows the last of them
+        self._filled_buffers = queue.Queue()
+        self._scanning_thread = threading.Thread(target=self._pass_on_buffers, daemon=True)
+
+        self.read_gaps = DurationStatistics('Time between reads of stdin')
+        self.full_ring_waits = DurationStatistics('Waits for a free buffer in the ring')
+
+    def start(self):
+        ''' Start reading stdin, and passing on what we read '''
+        self._scanning_thread.start()
+        super().start()
+
+    def run(self):
+        ''' Read stdin until it is finished '''
+        last_read_time = None
+        while True:
+            try:
+                buffer = self._free_buffers.get_nowait()
+            except queue.Empty:
+                # The ring is full, so the producer has to wait until we have scanned a buffer
+                wait_start = time.perf_counter()
+                buffer = self._free_buffers.get()
+                self.full_ring_waits.add(time.perf_counter() - wait_start)
+
+            if last_read_time is not None:
+                self.read_gaps.add(time.perf_counter() - last_read_time)
+            num_read = os.readv(self._fd, [buffer])
+            last_read_time = time.perf_counter()
+
+            if num_read == 0:
+                self._filled_buffers.put(None)
+                return
+            self._filled_buffers.put((buffer, num_read))
+
+    def _pass_on_buffers(self):
+        ''' Pass the text of each filled buffer on to the stores, and tell the plotter if it is waiting for data '''
+        while True:
+            filled = self._filled_buffers.get()
+            if filled is None:
+                text = _STDIN_DECODER.decode(b'', final=True)
+            else:
+                buffer, num_read = filled
+                text = _STDIN_DECODER.decode(memoryview(buffer)[:num_read])
+                # We have the text, so the buffer can be read into again straight away
+                self._free_buffers.put(buffer)
+
+            with _STORE_LOCK:
+                _STORE_SELECTOR.add_text(text)
+                if filled is None:
+                    _STORE_SELECTOR.finish()
+
+            try:
+                self._loop.call_soon_threadsafe(_PLOTTER_NOTIFIER.notify)
+            except RuntimeError:
+                # The event loop has been closed, so we are shutting down
+                return
+            if filled is None:
+                return
+
+
+def _take_frame_data(frame_store, signal):
+    ''' Return the response and data from frame_store for the given signal, and let the plotter notifier know that the
+        plotter has been given them
+    '''
+    with _STORE_LOCK:
+        response, data = frame_store.get_response_and_data(signal)
+        more_to_come = frame_store.has_complete_frame()
+    _PLOTTER_NOTIFIER.data_requested(more_to_come)
+    return response, data
 
 
 @coroutine
-def frame_sender(loop, plotter_process):
+def frame_sender(loop, plotter_process, frame_store):
     ''' Listen to the output from plotter stdout, and when we're told to advance to the next frame, deliver it on the
-        plotter's stdin
+        plotter's stdin from frame_store. The stores may be being filled on another thread, so we only use them while
+        holding _STORE_LOCK.
     '''
+    # We start out sending everything as lines, until asked otherwise
+    protocol = Protocol.lines
+    next_protocol = protocol
+    shared_memory_sender = None
+    frame_compiler = None
+    encoded_frame_cache = None
+
     while True:
         # Since we're here, we know that we can read from this file. This will yield bytes
         signal = yield from plotter_process.stdout.read(1)
         # convert buf to a string
         signal = signal.decode('ascii')
+        received_time = time.perf_counter()
 
         # Send more data along with the appropriate response
         if signal == SIGNAL_NEXT_FRAME or signal == SIGNAL_MORE_OF_SAME_FRAME:
-            response, data = _FRAME_STORE.get_response_and_data(signal)
+            response, data = _take_frame_data(frame_store, signal)
+            # Complete frames are often sent again unchanged, so we cache them rather than compiling them again
+            if frame_compiler is not None and response == RESPONSE_COMPLETE_FRAME:
+                data = encoded_frame_cache.encode(data)
+            elif frame_compiler is not None and response in FRAME_RESPONSES:
+                new_frame = response == RESPONSE_BEGIN_PARTIAL_FRAME
+                data = frame_compiler.compile(data, new_frame).encode()
 
         # Send the options to the process
         elif signal == SIGNAL_SEND_OPTIONS:
-            response, data = _OPTIONS_STORE.get_response_and_data()
+            with _STORE_LOCK:
+                response, data = _OPTIONS_STORE.get_response_and_data()
 
         # Are we switching dropping modes? Change the behaviour of the frame store appropriately
         elif signal == SIGNAL_ENTER_DROP_MODE:
-            _FRAME_STORE.store_all_frames = False
+            with _STORE_LOCK:
+                frame_store.store_all_frames = False
             response, data = RESPONSE_ACKNOWLEDGE, ''
 
         elif signal == SIGNAL_ENTER_NODROP_MODE:
-            _FRAME_STORE.store_all_frames = True
+            with _STORE_LOCK:
+                frame_store.store_all_frames = True
+            response, data = RESPONSE_ACKNOWLEDGE, ''
+
+        # We acknowledge this with the current protocol, and use the new one from then on
+        elif signal == SIGNAL_USE_BINARY_PROTOCOL:
+            next_protocol = Protocol.binary
+            response, data = RESPONSE_ACKNOWLEDGE, ''
+
+        elif signal == SIGNAL_USE_SHARED_MEMORY:
+            next_protocol = Protocol.shared_memory
+            shared_memory_sender = SharedMemorySender()
+            response, data = RESPONSE_ACKNOWLEDGE, ''
+
+        # From now on we compile frames before sending them, so the plotter needn't parse them
+        elif signal == SIGNAL_SEND_COMPILED_FRAMES:
+            frame_compiler = FrameCompiler()
+            encoded_frame_cache = EncodedFrameCache()
+            response, data = RESPONSE_ACKNOWLEDGE, ''
+
+        # The plotter wants to be told about new data. We tell it straight away, since we don't know what it has seen.
+        elif signal == SIGNAL_NOTIFY_ON_NEW_DATA:
+            _PLOTTER_NOTIFIER.enabled = True
+            _PLOTTER_NOTIFIER.notify()
+            response, data = RESPONSE_ACKNOWLEDGE, ''
+
+        # We're asked to skip to the most recent complete frame
+        elif signal == SIGNAL_CATCH_UP:
+            with _STORE_LOCK:
+                frame_store.catch_up()
             response, data = RESPONSE_ACKNOWLEDGE, ''
 
         # We've quit the plotter process, so we will terminate too
         elif signal == '':
+            if shared_memory_sender is not None:
+                shared_memory_sender.close()
             return
 
         else:
             raise ValueError('Unrecognised signal: {}'.format(signal))
 
-        # Send data back to the plotter as required. We send a response and a number of lines of data to expect
-        send_response_and_data(plotter_process.stdin, response, data)
+        # Send data back to the plotter as required, along with the response
+        if protocol is Protocol.shared_memory:
+            shared_memory_sender.send_response_and_data(plotter_process.stdin, response, data)
+        else:
+            send_response_and_data(plotter_process.stdin, response, data, protocol)
+        protocol = next_protocol
 
         # We use the drain coroutine to allow the event loop to actually perform this operation now
         yield from plotter_process.stdin.drain()
+        _RESPONSE_TIMES.add(time.perf_counter() - received_time)
 
 
 @coroutine
-def create_and_run_plotter(loop):
+def create_and_run_plotter(loop, frame_store):
     ''' Create the plotter subprocess, then send data to it as requested '''
-    # Create the plotter process
+    # Create the plotter process, with a pipe on which we can notify it of new data
+    notify_read_fd, notify_write_fd = os.pipe()
+    _set_non_blocking(notify_write_fd)
     command_and_args = [sys.executable] + sys.argv + [PLOTTER_ARGUMENT]
     plotter_process_create = asyncio.create_subprocess_exec(*command_and_args,
                                                             stdout=asyncio.subprocess.PIPE,
-                                                            stdin=asyncio.subprocess.PIPE)
+                                                            stdin=asyncio.subprocess.PIPE,
+                                                            pass_fds=(notify_read_fd,),
+                                                            env=dict(os.environ, **{
+                                                                NOTIFY_FD_ENVIRONMENT_VARIABLE: str(notify_read_fd)}))
     plotter_process = yield from plotter_process_create
+    os.close(notify_read_fd)
+    _PLOTTER_NOTIFIER.fd = notify_write_fd
 
     # Send data as requested
-    yield from frame_sender(loop, plotter_process)
+    yield from frame_sender(loop, plotter_process, frame_store)
 
     # Once we've finished sending data, we can quit the plotter
     try:
@@ -368,20 +823,38 @@ def gobbler_main(args):
     ''' Entry point for the gobbler '''
     # Add arguments to the options store
     _OPTIONS_STORE.add_arguments_to_data(args)
+    _FRAME_STORE.set_memory_budget(args.frame_memory_mb * (1 << 20))
 
     # The basic event loop
     loop = asyncio.get_event_loop()
 
-    # Read tokens from stdin
-    loop.add_reader(sys.stdin, read_frames, loop)
+    # Serve frames from a file if we're given one, otherwise read tokens from stdin, either on a thread of its own or
+    # in the event loop
+    ingestion_thread = None
+    if args.input:
+        frame_store = FileFrameStore(args.input)
+    elif args.ingestion_buffers > 0:
+        frame_store = _FRAME_STORE
+        ingestion_thread = IngestionThread(loop, args.ingestion_buffers)
+        ingestion_thread.start()
+    else:
+        frame_store = _FRAME_STORE
+        _set_non_blocking(sys.stdin.fileno())
+        loop.add_reader(sys.stdin.fileno(), read_frames, loop)
 
     # Create and run the plotter
     try:
-        loop.run_until_complete(create_and_run_plotter(loop))
+        loop.run_until_complete(create_and_run_plotter(loop, frame_store))
     except KeyboardInterrupt:
         # We're quite happy to quit on keyboard interrupt
         pass
 
+    if args.verbose:
+        sc_print(_RESPONSE_TIMES)
+        if ingestion_thread is not None:
+            sc_print(ingestion_thread.read_gaps)
+            sc_print(ingestion_thread.full_ring_waits)
+
     # Tidy up once we've stopped
     loop.close()
 
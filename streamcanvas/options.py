@@ -29,6 +29,28 @@ class DisplayMode(Enum):
     inspect_nodrop = 2    # Pause after each incoming frame, never miss a frame
 
 
+class UpdateMode(Enum):
+    ''' Represents the ways in which the plotter finds out about new data '''
+
+    timer = 0             # Ask the gobbler for data every window_update_time_ms
+    push = 1              # Ask only when the gobbler tells us it has something new, up to max_frame_rate
+
+
+class FrameFormat(Enum):
+    ''' Represents the forms in which the gobbler can send frames to the plotter '''
+
+    text = 0              # The tokens of the frame, which the plotter must parse
+    compiled = 1          # Opcodes and arrays of numbers, compiled by the gobbler. Needs the binary protocol.
+
+
+class Protocol(Enum):
+    ''' Represents the ways in which the gobbler can send data to the plotter '''
+
+    lines = 0             # A line giving the response and number of lines, followed by that many lines of text
+    binary = 1            # A response byte and 64-bit payload length, followed by the UTF-8 encoded payload
+    shared_memory = 2     # As binary, but large payloads are written to shared memory, and only located by the message
+
+
 class _Options:
     ''' Configurable options for the stream canvas. These are things that can be set by command line arguments or via an
         options block at the start of the command stream.
@@ -42,20 +64,36 @@ class _Options:
                 ('window_width', _Option(400, 'Width of the display window')),
                 ('window_height', _Option(400, 'Height of the display window')),
                 ('window_update_time_ms', _Option(50, 'Plot refresh time (ms)')),
+                ('update', _Option(UpdateMode.timer, 'How to find out about new data: timer, push')),
+                ('max_frame_rate', _Option(60.0, 'Most frames per second to show when using push updates, and most '
+                                                 'changes of the view range per second')),
                 ('mode', _Option(DisplayMode.live, 'Display mode: live, inspect_drop, inspect_nodrop')),
                 ('verbose', _Option(False, 'Should we log in verbose mode?')),
+                ('input', _Option('', 'Read frames from this file, rather than from stdin (command line only)')),
+                ('protocol', _Option(Protocol.binary, 'Protocol for sending data to the plotter: lines, binary, '
+                                                           'shared_memory')),
+                ('frame_format', _Option(FrameFormat.compiled, 'Form in which to send frames to the plotter: text, '
+                                                               'compiled')),
+                ('ingestion_buffers', _Option(0, 'If non-zero, read and scan stdin on separate threads, through a '
+                                                 'ring of this many buffers (command line only)')),
+                ('frame_memory_mb', _Option(1024, 'Memory (MB) for frames waiting to be shown in inspect_nodrop mode, '
+                                                  'beyond which they are kept on disk')),
 
                 # Options controlling drawing
                 ('point_extent', _Option(0.001, 'The "size" of a point when considering viewing range.')),
+                ('range_growth_margin', _Option(0.0, 'When the viewing range grows to fit new contents, grow it by '
+                                                     'this fraction more, so that it needs to change less often')),
                 ])
 
-    def apply_data(self, data):
+    def apply_data(self, data, log=True):
         ''' Apply the given data - a string - to the options herein and update values appropriately. If the same
-            option appears multiple times, the last time of appearance will take precedence
+            option appears multiple times, the last time of appearance will take precedence. If log is True, each
+            option is printed as it is applied.
         '''
         # This is a clever variant on the normal split that maintains quoted substrings
         for option_name, value_string in pairs(shlex.split(data), distinct=True):
-            sc_print('Option: {}: {}'.format(option_name, value_string))
+            if log:
+                sc_print('Option: {}: {}'.format(option_name, value_string))
             self._apply_datum(option_name, value_string)
 
     def _apply_datum(self, option_name, value_string):
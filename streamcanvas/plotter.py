@@ -3,7 +3,8 @@
 import sys
 import time
 
-from streamcanvas.communication import read_response_and_data, update_gobbler_dropping_mode
+from streamcanvas.communication import (negotiate_frame_format, negotiate_protocol, read_response_and_data,
+                                        update_gobbler_dropping_mode)
 from streamcanvas.constants import RESPONSE_OPTIONS, RESPONSE_OPTIONS_NOT_READY, SIGNAL_SEND_OPTIONS
 from streamcanvas.options import OPTIONS
 from streamcanvas.plotter_qt2d import StreamCanvasGUI
@@ -31,6 +32,10 @@ def plotter_main():
     # Tell the gobbler what sort of dropping mode to use, based on the options
     update_gobbler_dropping_mode()
 
+    # From here on, the gobbler may send us data with a more efficient protocol
+    negotiate_protocol()
+    negotiate_frame_format()
+
     gui = StreamCanvasGUI()
     gui.run()
 
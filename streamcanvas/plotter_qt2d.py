@@ -1,18 +1,28 @@
 ''' An implementation of the plotter components in Qt via pyqtgraph '''
 
+import functools
+import math
 import numpy
-import random
-import re
+import os
+import queue
 import sys
+import threading
+import time
+
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
+from enum import Enum
 
 import pyqtgraph
 from pyqtgraph.GraphicsScene import GraphicsScene
 from pyqtgraph.Qt import QtGui, QtCore
 
-from streamcanvas.communication import read_response_and_data, update_gobbler_dropping_mode
+from streamcanvas.communication import (ResponseReader, dropping_mode_signal, enable_new_data_notifications,
+                                        send_signal)
 from streamcanvas.constants import *
-from streamcanvas.options import DisplayMode, OPTIONS
-from streamcanvas.utils import pairs, sc_print
+from streamcanvas.frame_compiler import CompiledFrame, FrameCompiler, frame_digest
+from streamcanvas.options import DisplayMode, OPTIONS, UpdateMode
+from streamcanvas.utils import sc_print
 
 
 class StreamCanvasWindow(pyqtgraph.GraphicsWindow):
@@ -47,7 +57,10 @@ class StreamCanvasWindow(pyqtgraph.GraphicsWindow):
             OPTIONS.mode = new_mode
 
             # We may have updated the dropping mode, so inform the gobbler
-            update_gobbler_dropping_mode()
+            self._controller.update_gobbler_dropping_mode()
+
+            # The gobbler may already have data that we didn't want while inspecting, so don't wait to be told of more
+            self._controller.update()
 
         # If we're in either of the inspection modes, this should cause us to request a new frame, unless we're
         # still part way through receiving one, in which case it should do nothing
@@ -60,199 +73,1121 @@ class StreamCanvasWindow(pyqtgraph.GraphicsWindow):
             if advance_made and OPTIONS.verbose:
                 sc_print('Advancing frame')
 
+        # In non-dropping inspection mode, 'c' catches up to the most recent complete frame, allowing the gobbler to
+        # discard all of the frames in between
+        elif event.key() == QtCore.Qt.Key_C:
+            if OPTIONS.mode is not DisplayMode.inspect_nodrop:
+                return
+
+            advance_made = self._controller.request_catch_up()
+            if advance_made and OPTIONS.verbose:
+                sc_print('Catching up to the most recent frame')
+
+
+def _points_box(points):
+    ''' Return the box (x_min, y_min, x_max, y_max) around the given array of points of shape (n, 2), which must not be
+        empty, with each point taken to have an extent of point_extent
+    '''
+    x_min, y_min = points.min(axis=0) - OPTIONS.point_extent
+    x_max, y_max = points.max(axis=0) + OPTIONS.point_extent
+    return x_min, y_min, x_max, y_max
+
+
+def _united_boxes(box, other_box):
+    ''' Return the smallest box containing both of the given boxes, either of which may be None '''
+    if box is None:
+        return other_box
+    if other_box is None:
+        return box
+    return (min(box[0], other_box[0]), min(box[1], other_box[1]),
+            max(box[2], other_box[2]), max(box[3], other_box[3]))
+
+
+def _grown_box(box, other_box, margin):
+    ''' Return box grown to contain other_box. Each side that has to move is pushed out further, by margin times the
+        size of the grown box.
+    '''
+    x_min, y_min, x_max, y_max = _united_boxes(box, other_box)
+    x_margin = margin * (x_max - x_min)
+    y_margin = margin * (y_max - y_min)
+    return (x_min - x_margin if x_min < box[0] else x_min, y_min - y_margin if y_min < box[1] else y_min,
+            x_max + x_margin if x_max > box[2] else x_max, y_max + y_margin if y_max > box[3] else y_max)
+
+
+def _box_rect(box):
+    ''' Return the Qt rectangle of the given box '''
+    x_min, y_min, x_max, y_max = box
+    return QtCore.QRectF(x_min, y_min, x_max - x_min, y_max - y_min)
+
+
+def _boxes_intersect(box, other_box):
+    ''' Return True iff the two boxes, each given as (x_min, y_min, x_max, y_max), intersect '''
+    return (box[0] <= other_box[2] and other_box[0] <= box[2]
+            and box[1] <= other_box[3] and other_box[1] <= box[3])
+
+
+def _culled(draw, box):
+    ''' Return a painter call that makes the given draw call only if the box that it draws within is visible '''
+    def call(painter, visible_box):
+        if _boxes_intersect(box, visible_box):
+            draw(painter)
+    return call
+
+
+def _rect_boxes(rects):
+    ''' Return the boxes of an array of rectangles of shape (n, 4), each given as (x, y, width, height) '''
+    corners = rects[:, :2] + rects[:, 2:]
+    return numpy.concatenate((numpy.minimum(rects[:, :2], corners), numpy.maximum(rects[:, :2], corners)), axis=1)
+
+
+# Paths and polygons are built in one go from the form in which QDataStream serializes them, in the same way as
+# pyqtgraph.arrayToQPath, rather than one element at a time. Each element of a path has one of these types.
+_PATH_ELEMENT = numpy.dtype([('type', '>i4'), ('x', '>f8'), ('y', '>f8')])
+_MOVE_TO, _LINE_TO, _CURVE_TO, _CURVE_TO_DATA = range(4)
+
+# The corners of a rectangle, and the elements of an ellipse as the four cubic curves with which QPainterPath.addEllipse
+# draws one, given for a unit square and a unit circle respectively
+_RECT_TYPES = numpy.array([_MOVE_TO] + [_LINE_TO] * 4)
+_RECT_CORNERS = numpy.array([(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)], dtype=numpy.float64)
+_KAPPA = 0.5522847498
+_ELLIPSE_TYPES = numpy.array([_MOVE_TO] + [_CURVE_TO, _CURVE_TO_DATA, _CURVE_TO_DATA] * 4)
+_ELLIPSE_POINTS = numpy.array([(1, 0),
+                               (1, -_KAPPA), (_KAPPA, -1), (0, -1),
+                               (-_KAPPA, -1), (-1, -_KAPPA), (-1, 0),
+                               (-1, _KAPPA), (-_KAPPA, 1), (0, 1),
+                               (_KAPPA, 1), (1, _KAPPA), (1, 0)], dtype=numpy.float64)
+
+
+def _array_to_path(types, points):
+    ''' Return the path with the given element types and array of points of shape (n, 2) '''
+    elements = numpy.empty(len(points), dtype=_PATH_ELEMENT)
+    elements['type'] = types
+    elements['x'] = points[:, 0]
+    elements['y'] = points[:, 1]
+    # The elements are preceded by their number and followed by the fill rule, which is 0 for odd-even
+    data = b''.join((numpy.array([len(elements)], dtype='>i4').tobytes(), elements.tobytes(),
+                     numpy.zeros(1, dtype='>i4').tobytes()))
+    path = QtGui.QPainterPath()
+    QtCore.QDataStream(QtCore.QByteArray(data)) >> path
+    return path
+
+
+def _array_to_polygon(points):
+    ''' Return the polygon of the given array of points of shape (n, 2) '''
+    data = numpy.array([len(points)], dtype='>u4').tobytes() + points.astype('>f8').tobytes()
+    polygon = QtGui.QPolygonF()
+    QtCore.QDataStream(QtCore.QByteArray(data)) >> polygon
+    return polygon
+
+
+def _outline_elements(polylines, rects, ellipses):
+    ''' Return the types and points of the path elements that outline the given polylines, rectangles and ellipses '''
+    types = []
+    points = []
+    if len(polylines) > 0:
+        polyline_points = numpy.concatenate(polylines)
+        # Each polyline starts with a move, and is joined up from there
+        polyline_types = numpy.full(len(polyline_points), _LINE_TO)
+        polyline_types[numpy.cumsum([0] + [len(polyline) for polyline in polylines[:-1]])] = _MOVE_TO
+        types.append(polyline_types)
+        points.append(polyline_points)
+    if len(rects) > 0:
+        types.append(numpy.tile(_RECT_TYPES, len(rects)))
+        points.append((rects[:, numpy.newaxis, :2] + _RECT_CORNERS * rects[:, numpy.newaxis, 2:]).reshape(-1, 2))
+    if len(ellipses) > 0:
+        radii = ellipses[:, numpy.newaxis, 2:] / 2
+        centres = ellipses[:, numpy.newaxis, :2] + radii
+        types.append(numpy.tile(_ELLIPSE_TYPES, len(ellipses)))
+        points.append((centres + _ELLIPSE_POINTS * radii).reshape(-1, 2))
+    if len(points) == 0:
+        return None, None
+    return numpy.concatenate(types), numpy.concatenate(points)
+
+
+# We split a batch into tiles with about this many primitives in each, up to _MAX_TILES_PER_AXIS along each axis
+_PRIMITIVES_PER_TILE = 256
+_MAX_TILES_PER_AXIS = 16
+
+
+class _DrawBatch:
+    ''' Primitives that are drawn consecutively with the same pen. Since the pen is all that we draw them with, we
+        can merge the outlines into a single path, and the points into a single polygon, so that drawing the batch takes
+        very few calls however many primitives it has. The path and polygon are built straight from arrays of the
+        primitives, so building them doesn't take a Python call for each primitive either.
+
+        So that we only draw what is visible, a large batch is first divided into a grid of tiles, with each primitive
+        belonging to the tile that contains the centre of its box. Each tile is drawn with its own path and polygon,
+        but only if the box around all of its primitives is visible.
+
+        Each rectangle or ellipse is given as (x, y, width, height), each point as (x, y), and each polyline as an
+        array of points of shape (n, 2).
+    '''
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        ''' Remove all primitives from the batch '''
+        self.rects = []
+        self.ellipses = []
+        self.points = []
+        self.polylines = []
+
+    def flush(self, calls, bounds):
+        ''' Append the calls that draw the batch to calls, and empty it. Return the box bounds, which may be None,
+            expanded to contain the batch.
+        '''
+        polylines = [polyline for polyline in self.polylines if len(polyline) > 0]
+        rects = numpy.array(self.rects, dtype=numpy.float64).reshape(-1, 4)
+        ellipses = numpy.array(self.ellipses, dtype=numpy.float64).reshape(-1, 4)
+        points = numpy.array(self.points, dtype=numpy.float64).reshape(-1, 2)
+        self._clear()
+
+        # The box around each primitive, in the order polylines, rectangles, ellipses and points
+        extent = OPTIONS.point_extent
+        polyline_boxes = numpy.array([_points_box(polyline) for polyline in polylines]).reshape(-1, 4)
+        boxes = numpy.concatenate((polyline_boxes, _rect_boxes(rects), _rect_boxes(ellipses),
+                                   numpy.concatenate((points - extent, points + extent), axis=1)))
+        if len(boxes) == 0:
+            return bounds
+
+        batch_box = tuple(numpy.concatenate((boxes[:, :2].min(axis=0), boxes[:, 2:].max(axis=0))))
+        bounds = _united_boxes(bounds, batch_box)
+
+        tiles = self._tiles(boxes, batch_box)
+        rects_start = len(polylines)
+        ellipses_start = rects_start + len(rects)
+        points_start = ellipses_start + len(ellipses)
+        for tile in numpy.unique(tiles):
+            in_tile = tiles == tile
+            tile_boxes = boxes[in_tile]
+            box = tuple(numpy.concatenate((tile_boxes[:, :2].min(axis=0), tile_boxes[:, 2:].max(axis=0))))
+            self._add_calls(calls, box,
+                            [polyline for polyline, include in zip(polylines, in_tile) if include],
+                            rects[in_tile[rects_start:ellipses_start]],
+                            ellipses[in_tile[ellipses_start:points_start]],
+                            points[in_tile[points_start:]])
+        return bounds
+
+    @staticmethod
+    def _tiles(boxes, box):
+        ''' Return the index of the tile to which each of the given boxes belongs, where the tiles divide up box '''
+        num_tiles_per_axis = min(_MAX_TILES_PER_AXIS, math.ceil(math.sqrt(len(boxes) / _PRIMITIVES_PER_TILE)))
+        if num_tiles_per_axis <= 1:
+            return numpy.zeros(len(boxes), dtype=numpy.intp)
+
+        origin = numpy.array(box[:2])
+        size = numpy.maximum(numpy.array(box[2:]) - origin, 1e-300)
+        centres = (boxes[:, :2] + boxes[:, 2:]) / 2
+        tile_xy = ((centres - origin) / size * num_tiles_per_axis).astype(numpy.intp)
+        tile_xy = numpy.clip(tile_xy, 0, num_tiles_per_axis - 1)
+        return tile_xy[:, 1] * num_tiles_per_axis + tile_xy[:, 0]
+
+    @staticmethod
+    def _add_calls(calls, box, polylines, rects, ellipses, points):
+        ''' Append the calls that draw the given primitives, which all lie within box, to calls '''
+        types, outline_points = _outline_elements(polylines, rects, ellipses)
+        if types is not None:
+            path = _array_to_path(types, outline_points)
+            calls.append(_culled(lambda painter, path=path: painter.drawPath(path), box))
+
+        if len(points) > 0:
+            polygon = _array_to_polygon(points)
+            calls.append(_culled(lambda painter, polygon=polygon: painter.drawPoints(polygon), box))
+
+
+# The number of points for which each pen has room at first
+_INITIAL_PEN_CAPACITY = 1024
+
+# Polylines with fewer points than this are always drawn in full
+_MIN_POINTS_TO_DECIMATE = 4096
+
+
+def _zoom_level(x_pixel_size):
+    ''' Return the zoom level at which a pixel is x_pixel_size wide, or None if that isn't known. Polylines are
+        decimated into columns that are 2 ** level wide.
+    '''
+    if x_pixel_size is None:
+        return None
+    return math.floor(math.log2(x_pixel_size))
+
+
+def _decimate(points, segment_starts, column_width):
+    ''' Reduce a polyline, given as an array of points of shape (n, 2), to at most four points for each run of
+        consecutive points that lie within the same column of the given width: the first and last points of the run,
+        and its lowest and highest values. A run also ends wherever a new segment starts. Since a column is no wider
+        than a pixel, the envelope drawn is unchanged.
+
+        Return the points, and the connect mask with which to draw them.
+    '''
+    x = points[:, 0]
+    y = points[:, 1]
+    columns = numpy.floor(x / column_width)
+
+    is_segment_start = numpy.zeros(len(points), dtype=bool)
+    is_segment_start[[start for start in segment_starts if start < len(points)]] = True
+    is_run_start = is_segment_start.copy()
+    is_run_start[0] = True
+    is_run_start[1:] |= columns[1:] != columns[:-1]
+    starts = numpy.flatnonzero(is_run_start)
+    ends = numpy.append(starts[1:], len(points)) - 1
+
+    decimated = numpy.empty((len(starts), 4, 2))
+    decimated[:, 0] = points[starts]
+    decimated[:, 1:3, 0] = x[starts, numpy.newaxis]
+    decimated[:, 1, 1] = numpy.minimum.reduceat(y, starts)
+    decimated[:, 2, 1] = numpy.maximum.reduceat(y, starts)
+    decimated[:, 3] = points[ends]
+
+    # Runs are joined to each other, except where the next run starts a new segment
+    connect = numpy.ones((len(starts), 4), dtype=numpy.ubyte)
+    connect[:-1, 3] = ~is_segment_start[starts[1:]]
+    return decimated.reshape(-1, 2), connect.reshape(-1)
+
+
+class _PolylineBuffer:
+    ''' The points of a polyline, such as those drawn by a named pen, held in an array that doubles in size whenever it
+        runs out of room, so that appending points takes time in proportion to their number rather than to the number
+        that came before.
+
+        A break starts a new segment, which isn't joined to the previous one; we keep the offset at which each segment
+        starts. The full path is extended with only the points added since it was last updated. When zoomed out far
+        enough for many points to share a pixel column, we draw a decimated path instead, which we keep for each
+        zoom level until more points are added.
+    '''
+
+    def __init__(self):
+        self._points = numpy.empty((_INITIAL_PEN_CAPACITY, 2))
+        self.num_points = 0
+        self.segment_starts = [0]
+        self._full_path = QtGui.QPainterPath()
+        self._path_end = 0
+        self._level_to_decimated_path = {}
+        # The box around the points in the path, or None if there are none
+        self.box = None
+
+    @property
+    def points(self):
+        ''' The points drawn so far, as an array of shape (n, 2) '''
+        return self._points[:self.num_points]
+
+    def append(self, points):
+        ''' Add an array of points of shape (n, 2) to the current segment '''
+        end = self.num_points + len(points)
+        if end > len(self._points):
+            new_points = numpy.empty((max(end, 2 * len(self._points)), 2))
+            new_points[:self.num_points] = self.points
+            self._points = new_points
+        self._points[self.num_points:end] = points
+        self.num_points = end
+
+    def break_(self):
+        ''' Start a new segment, so that the next point isn't joined to the last '''
+        if self.segment_starts[-1] != self.num_points:
+            self.segment_starts.append(self.num_points)
+
+    def draw(self, painter, visible_box, x_pixel_size):
+        ''' Draw the polyline, if it is within the visible box '''
+        if self.box is not None and _boxes_intersect(self.box, visible_box):
+            painter.drawPath(self.path(x_pixel_size))
+
+    def path(self, x_pixel_size):
+        ''' Return the path to draw when each pixel is x_pixel_size wide, which is None if that isn't known '''
+        level = _zoom_level(x_pixel_size)
+        if level is None or self.num_points < _MIN_POINTS_TO_DECIMATE:
+            return self._full_path
+
+        # Columns are a power of two wide, no wider than a pixel, and aligned to zero, so the same decimation serves
+        # everywhere that we pan to at this zoom level
+        path = self._level_to_decimated_path.get(level)
+        if path is None:
+            points, connect = _decimate(self.points, self.segment_starts, 2.0 ** level)
+            if 2 * len(points) > self.num_points:
+                # Decimating doesn't save enough to be worthwhile
+                path = self._full_path
+            else:
+                path = pyqtgraph.arrayToQPath(points[:, 0], points[:, 1], connect=connect)
+            self._level_to_decimated_path[level] = path
+        return path
+
+    def update_path(self):
+        ''' Extend the path with the points added since it was last updated, and return the box around those points,
+            or None if there are none
+        '''
+        start, end = self._path_end, self.num_points
+        if start == end:
+            return None
+        self._level_to_decimated_path = {}
+        new_box = _points_box(self._points[start:end])
+        self.box = _united_boxes(self.box, new_box)
+
+        # Join on from the last point already in the path, unless there has been a break since
+        segment_starts = self.segment_starts
+        index = bisect_left(segment_starts, start)
+        if start > 0 and (index == len(segment_starts) or segment_starts[index] != start):
+            start -= 1
+
+        # Each point is joined to the next, except for the last point before a break
+        connect = numpy.ones(end - start, dtype=numpy.ubyte)
+        for segment_start in segment_starts[bisect_right(segment_starts, start):bisect_left(segment_starts, end)]:
+            connect[segment_start - 1 - start] = 0
+
+        self._full_path.addPath(pyqtgraph.arrayToQPath(self._points[start:end, 0], self._points[start:end, 1],
+                                                 connect=connect))
+        self._path_end = end
+        return new_box
+
+
+# The most pens that we keep for reuse, with the least recently used discarded first
+_PEN_CACHE_SIZE = 256
+
+
+@functools.lru_cache(maxsize=_PEN_CACHE_SIZE)
+def _cached_pen(rgba, width=1):
+    ''' Return a pen with the given colour, as normalized (red, green, blue, alpha), and width. Pens are shared between
+        frames, so they mustn't be modified.
+    '''
+    return pyqtgraph.mkPen(QtGui.QColor.fromRgbF(*rgba), width=width)
+
+
+# Frames are drawn in steps of about this many seconds, between which other threads get their turn and we check
+# whether the frame is still wanted. We check the time after every so many commands.
+_DRAWING_STEP_TIME = 0.005
+_COMMANDS_PER_TIME_CHECK = 64
+
+
+class _FrameAbandoned(Exception):
+    ''' Raised when we stop drawing a frame because it is no longer wanted '''
+
+
+def _end_drawing_step(abandoned):
+    ''' Let other threads run between steps of drawing a frame, and then carry on unless the abandoned event has been
+        set. This may be None if the frame can't be abandoned.
+    '''
+    time.sleep(0)
+    if abandoned is not None and abandoned.is_set():
+        raise _FrameAbandoned()
+
+
+# We replay the picture of a complete frame rather than drawing just what is visible, unless less than this fraction of
+# the frame is visible
+_PICTURE_MIN_VISIBLE_FRACTION = 0.25
+
+
+class _FrameDrawing:
+    ''' Everything needed to draw a frame, or as much of it as we have so far. Nothing here touches the GUI, so a
+        drawing can be built (and recorded or rasterized) on any thread.
+    '''
+
+    def __init__(self, x_pixel_size=None):
+        # This keeps track of any command that is split between parts of a frame sent as text
+        self._frame_compiler = FrameCompiler()
+
+        # This will be a list of function calls that expect to be called with the painter object and the visible box,
+        # given as (x_min, y_min, x_max, y_max)
+        self._painter_function_calls = []
+
+        # The points drawn by each pen so far, which are drawn after all the other calls
+        self._name_to_pen = {}
+
+        # The pens of each colour used in the frame, and the index of each colour's pen. Colour changes are drawn by
+        # calls that refer to the pen by its index.
+        self._pens = []
+        self._colour_to_pen_index = {}
+        self._current_pen_index = None
+
+        # The changes to the retained scene made by the last part of the frame that was added
+        self.scene_edits = []
+
+        # The width of a pixel in the view, once we know it, which determines how much we decimate long polylines
+        self.x_pixel_size = x_pixel_size
+
+        # Once a frame is complete, we record everything that draws it in a picture, which Qt can replay without
+        # calling back into Python. This is kept until the frame changes, or we zoom enough to decimate differently.
+        self.complete = False
+        self._picture = None
+        self._picture_zoom_level = None
+
+        # The box around everything in the frame, which is None until there is something in it
+        self.content_box = None
+
+    def draw(self, painter, visible_box):
+        ''' Draw everything within the visible box, given as (x_min, y_min, x_max, y_max) '''
+        for call in self._painter_function_calls:
+            call(painter, visible_box)
+        for pen in self._name_to_pen.values():
+            pen.draw(painter, visible_box, self.x_pixel_size)
+
+    def picture(self):
+        ''' Return the picture of the whole frame, recording it if necessary '''
+        if self._picture is None:
+            picture = QtGui.QPicture()
+            painter = QtGui.QPainter(picture)
+            self.draw(painter, (-math.inf, -math.inf, math.inf, math.inf))
+            painter.end()
+            self._picture = picture
+            self._picture_zoom_level = _zoom_level(self.x_pixel_size)
+        return self._picture
+
+    def mostly_visible(self, visible_box):
+        ''' Return True iff at least _PICTURE_MIN_VISIBLE_FRACTION of the frame's area is within the visible box '''
+        if self.content_box is None:
+            return True
+        x_min, y_min, x_max, y_max = self.content_box
+        x_overlap = min(x_max, visible_box[2]) - max(x_min, visible_box[0])
+        y_overlap = min(y_max, visible_box[3]) - max(y_min, visible_box[1])
+        visible_area = max(x_overlap, 0) * max(y_overlap, 0)
+        return visible_area >= _PICTURE_MIN_VISIBLE_FRACTION * (x_max - x_min) * (y_max - y_min)
+
+    def set_x_pixel_size(self, x_pixel_size):
+        ''' Set the width of a pixel in the view '''
+        self.x_pixel_size = x_pixel_size
+        # Long polylines may now be decimated differently
+        if _zoom_level(x_pixel_size) != self._picture_zoom_level:
+            self._picture = None
+
+    def add(self, frame_data, complete, abandoned=None):
+        ''' Add the next part of the frame, which completes it if complete is True. It arrives either compiled by the
+            gobbler, or as text. Only the new data is parsed, and its calls are added to those we already have, so
+            drawing a frame progressively costs no more than drawing it all at once.
+
+            If abandoned is given, it is an event that is set if the frame is no longer wanted, in which case we raise
+            _FrameAbandoned and the drawing must not be used. Its changes to the retained scene must still be made,
+            though, so all of these are found before we give up.
+
+            Return the box around what was added, which is None if nothing was. The changes that it makes to the
+            retained scene are left in scene_edits.
+        '''
+        self.scene_edits = []
+        if isinstance(frame_data, bytes):
+            frame = CompiledFrame.decode(frame_data)
+        else:
+            frame = self._frame_compiler.compile(frame_data, new_frame=False)
+        return self._add_painter_calls(frame, complete, abandoned)
+
+    def _add_painter_calls(self, frame, complete, abandoned):
+        ''' Cache the painter function calls that we need to make to draw the given compiled frame, which follows on
+            from anything that we have already, and completes the frame if complete is True. Return the box around
+            everything that they draw.
+
+            This is done in steps of bounded time, so that a huge frame neither starves other threads nor carries on
+            once it has been abandoned.
+        '''
+        self.complete = complete
+        self._picture = None
+
+        # Store the limits of everything we plot, as (x_min, y_min, x_max, y_max). These are taken from the arrays of
+        # each batch and line at once, and are None until we have plotted something.
+        bounds = None
+        if len(frame) == 0:
+            return bounds
+
+        batch = _DrawBatch()
+        handlers = _COMMAND_HANDLERS
+        step_end = time.perf_counter() + _DRAWING_STEP_TIME
+        num_until_time_check = _COMMANDS_PER_TIME_CHECK
+
+        # The arguments of each command are then views of a single array, without any copying. Commands that we don't
+        # draw, or that have the wrong number of arguments, are ignored.
+        commands = frame.commands(numpy.frombuffer(frame.numbers, dtype=numpy.float64))
+        try:
+            _end_drawing_step(abandoned)
+            for command, name, data in commands:
+                handler = handlers.get(command)
+                if handler is not None and handler.accepts(data):
+                    # A primitive with an id belongs to the retained scene rather than to this frame
+                    if name is not None and handler.retain is not None:
+                        self._retain(command, name, data)
+                    else:
+                        box = handler.draw(self, batch, name, handler.arguments(data))
+                        if box is not None:
+                            bounds = _united_boxes(bounds, box)
+
+                num_until_time_check -= 1
+                if num_until_time_check == 0:
+                    num_until_time_check = _COMMANDS_PER_TIME_CHECK
+                    if time.perf_counter() > step_end:
+                        _end_drawing_step(abandoned)
+                        step_end = time.perf_counter() + _DRAWING_STEP_TIME
+        except _FrameAbandoned:
+            self._add_scene_edits(commands)
+            raise
+
+        _end_drawing_step(abandoned)
+        bounds = batch.flush(self._painter_function_calls, bounds)
+        for pen in self._name_to_pen.values():
+            _end_drawing_step(abandoned)
+            bounds = _united_boxes(bounds, pen.update_path())
+
+        self.content_box = _united_boxes(self.content_box, bounds)
+        return bounds
+
+    def _add_scene_edits(self, commands):
+        ''' Find the changes to the retained scene made by the given commands, without drawing anything else '''
+        for command, name, data in commands:
+            handler = _COMMAND_HANDLERS.get(command)
+            if handler is None or not handler.accepts(data):
+                continue
+            if name is not None and handler.retain is not None:
+                self._retain(command, name, data)
+            # Retained objects are drawn with the pen that was current when they were given
+            elif command == 'colour':
+                self._select_pen(data)
+            elif command in _SCENE_EDIT_COMMANDS:
+                handler.draw(self, None, name, handler.arguments(data))
+
+    def _retain(self, command, object_id, data):
+        ''' Put the object drawn by the given primitive in the retained scene, in place of any with the same id '''
+        pen = _DEFAULT_PEN if self._current_pen_index is None else self._pens[self._current_pen_index]
+        self.scene_edits.append(_SceneEdit(object_id, command, data.copy(), pen))
+
+    def _select_pen(self, colour):
+        ''' Make the pen of the given colour current, adding it to the table of pens if necessary. A colour without any
+            numbers returns to the default pen, which has no index.
+        '''
+        if len(colour) == 0:
+            self._current_pen_index = None
+            return
+        colour = tuple(colour.tolist())
+        pen_index = self._colour_to_pen_index.get(colour)
+        if pen_index is None:
+            pen_index = self._colour_to_pen_index[colour] = len(self._pens)
+            self._pens.append(_cached_pen(colour))
+        self._current_pen_index = pen_index
+
+    # Each of the following draws a command, given the batch of primitives being drawn with the current pen, the name
+    # given to the command (if it takes one), and its arguments as laid out by its handler. Any box that is returned
+    # is around something drawn outside of the batch.
+
+    def _set_colour(self, batch, name, colour):
+        ''' Set the pen colour, which has been normalized to RGBA values between 0 and 1, or return to the default pen
+            if there are no values
+        '''
+        old_pen_index = self._current_pen_index
+        self._select_pen(colour)
+        pen_index = self._current_pen_index
+        # Setting the pen that we already have doesn't need to split the batch
+        if pen_index == old_pen_index:
+            return None
+        pens = self._pens
+        # Everything drawn so far was drawn with the previous pen
+        box = batch.flush(self._painter_function_calls, None)
+        if pen_index is None:
+            self._painter_function_calls.append(lambda painter, visible_box: painter.setPen(_DEFAULT_PEN))
+        else:
+            self._painter_function_calls.append(
+                lambda painter, visible_box, pen_index=pen_index: painter.setPen(pens[pen_index]))
+        return box
+
+    def _draw_rect(self, batch, name, rect):
+        ''' Draw a rectangle, given as (x, y, width, height) '''
+        batch.rects.append(rect)
+
+    def _draw_ellipse(self, batch, name, rect):
+        ''' Draw an ellipse, given by its bounding rectangle '''
+        batch.ellipses.append(rect)
+
+    def _draw_circle(self, batch, name, data):
+        ''' Draw a circle defined by centre, and radius '''
+        x, y, radius = data[0], data[1], data[2]
+        batch.ellipses.append((x - radius, y - radius, 2 * radius, 2 * radius))
+
+    def _draw_point(self, batch, name, point):
+        ''' Draw a point '''
+        batch.points.append(point)
+
+    def _draw_line(self, batch, name, points):
+        ''' Draw a multi-segment line. If it is long enough to be worth decimating, it is drawn on its own. '''
+        if len(points) < _MIN_POINTS_TO_DECIMATE:
+            batch.polylines.append(points)
+            return None
+        line = _PolylineBuffer()
+        line.append(points)
+        self._painter_function_calls.append(
+            lambda painter, visible_box: line.draw(painter, visible_box, self.x_pixel_size))
+        return line.update_path()
+
+    def _draw_closed_line(self, batch, name, points):
+        ''' Draw a multi-segment line, closed back to the start '''
+        batch.polylines.append(numpy.concatenate((points, points[:1])))
+
+    def _move_pen(self, batch, name, points):
+        ''' Move the named pen through the given points, creating it if necessary '''
+        if name not in self._name_to_pen:
+            self._name_to_pen[name] = _PolylineBuffer()
+        self._name_to_pen[name].append(points)
+
+    def _break_pen(self, batch, name, data):
+        ''' Lift the named pen, so that it isn't joined to where it goes next '''
+        if name in self._name_to_pen:
+            self._name_to_pen[name].break_()
+
+    def _update_object(self, batch, object_id, data):
+        ''' Give new arguments to the object in the retained scene with the given id '''
+        self.scene_edits.append(_SceneEdit(object_id, 'update', data.copy(), None))
+
+    def _delete_object(self, batch, object_id, data):
+        ''' Remove the object with the given id from the retained scene '''
+        self.scene_edits.append(_SceneEdit(object_id, 'delete', None, None))
+
+    @staticmethod
+    def _points_array(data):
+        ''' Return an array of shape (n, 2) of the points given by consecutive pairs of numbers in data. As with pairs
+            of arguments elsewhere, an unpaired final number is ignored.
+        '''
+        return data[:len(data) - len(data) % 2].reshape(-1, 2)
+
+
+class _ArgumentLayout(Enum):
+    ''' How the numbers given to a command are passed to its handler '''
+    numbers = 0     # As they are
+    points = 1      # As an array of points of shape (n, 2)
+
+
+class _CommandHandler(namedtuple('_CommandHandler', ('min_numbers', 'max_numbers', 'layout', 'draw', 'retain'))):
+    ''' How to draw a command. It takes at least min_numbers numbers, and at most max_numbers unless that is None. These
+        are laid out for the draw method of _FrameDrawing as given by layout.
+
+        A primitive that can be given an id, and so kept in the retained scene, has a retain function. This takes the
+        arguments as laid out, and returns the box around the object and a function that draws it with a painter, or
+        None if there is nothing to draw. Other commands have a retain function of None.
+    '''
+
+    def accepts(self, numbers):
+        ''' Return True iff the command can be given the given numbers '''
+        return len(numbers) >= self.min_numbers and (self.max_numbers is None or len(numbers) <= self.max_numbers)
+
+    def arguments(self, numbers):
+        ''' Return the given numbers laid out as the command's arguments '''
+        if self.layout is _ArgumentLayout.points:
+            return _FrameDrawing._points_array(numbers)
+        return numbers
+
+
+def _retained_rect(rect):
+    ''' Return the box and draw function of a retained rectangle '''
+    qt_rect = QtCore.QRectF(*rect.tolist())
+    return tuple(_rect_boxes(rect.reshape(1, 4))[0]), lambda painter: painter.drawRect(qt_rect)
+
+
+def _retained_ellipse(rect):
+    ''' Return the box and draw function of a retained ellipse '''
+    qt_rect = QtCore.QRectF(*rect.tolist())
+    return tuple(_rect_boxes(rect.reshape(1, 4))[0]), lambda painter: painter.drawEllipse(qt_rect)
+
+
+def _retained_circle(data):
+    ''' Return the box and draw function of a retained circle '''
+    x, y, radius = data[:3].tolist()
+    qt_rect = QtCore.QRectF(x - radius, y - radius, 2 * radius, 2 * radius)
+    return (x - radius, y - radius, x + radius, y + radius), lambda painter: painter.drawEllipse(qt_rect)
+
+
+def _retained_point(point):
+    ''' Return the box and draw function of a retained point '''
+    qt_point = QtCore.QPointF(*point.tolist())
+    return _points_box(point.reshape(1, 2)), lambda painter: painter.drawPoint(qt_point)
+
+
+def _retained_line(points):
+    ''' Return the box and draw function of a retained multi-segment line '''
+    if len(points) == 0:
+        return None
+    path = pyqtgraph.arrayToQPath(points[:, 0], points[:, 1])
+    return _points_box(points), lambda painter: painter.drawPath(path)
+
+
+def _retained_closed_line(points):
+    ''' Return the box and draw function of a retained multi-segment line, closed back to the start '''
+    return _retained_line(numpy.concatenate((points, points[:1])))
+
+
+# The handler of each command that we draw. Adding a command needs an entry here, and an opcode in the frame compiler.
+_COMMAND_HANDLERS = {
+    'colour': _CommandHandler(0, 4, _ArgumentLayout.numbers, _FrameDrawing._set_colour, None),
+    'rect': _CommandHandler(4, 4, _ArgumentLayout.numbers, _FrameDrawing._draw_rect, _retained_rect),
+    'ellipse': _CommandHandler(4, 4, _ArgumentLayout.numbers, _FrameDrawing._draw_ellipse, _retained_ellipse),
+    'circle': _CommandHandler(3, None, _ArgumentLayout.numbers, _FrameDrawing._draw_circle, _retained_circle),
+    'point': _CommandHandler(2, 2, _ArgumentLayout.numbers, _FrameDrawing._draw_point, _retained_point),
+    'line': _CommandHandler(0, None, _ArgumentLayout.points, _FrameDrawing._draw_line, _retained_line),
+    'lineclosed': _CommandHandler(0, None, _ArgumentLayout.points, _FrameDrawing._draw_closed_line,
+                                  _retained_closed_line),
+    'pen': _CommandHandler(0, None, _ArgumentLayout.points, _FrameDrawing._move_pen, None),
+    'break': _CommandHandler(0, None, _ArgumentLayout.numbers, _FrameDrawing._break_pen, None),
+    'update': _CommandHandler(0, None, _ArgumentLayout.numbers, _FrameDrawing._update_object, None),
+    'delete': _CommandHandler(0, None, _ArgumentLayout.numbers, _FrameDrawing._delete_object, None)}
+
+# The commands other than primitives with ids that change the retained scene
+_SCENE_EDIT_COMMANDS = ('update', 'delete')
+
+# The pen with which retained objects are drawn if no colour has been given, which is a painter's default
+_DEFAULT_PEN = QtGui.QPen()
+
+
+class _SceneEdit(namedtuple('_SceneEdit', ('object_id', 'command', 'numbers', 'pen'))):
+    ''' A change to the retained scene. The command is either a primitive, which replaces any object with the same id,
+        'update', which gives the object new numbers, or 'delete', which removes it. A primitive is drawn with the
+        given pen.
+    '''
+
+
+class _RetainedObject(namedtuple('_RetainedObject', ('command', 'pen', 'box', 'draw'))):
+    ''' An object in the retained scene, drawn by the given primitive and pen. The box is around everything that it
+        draws, and draw is a function that draws it with a painter.
+    '''
+
+
+class _RetainedScene:
+    ''' The objects drawn by primitives that were given ids, which are kept from one frame to the next until they are
+        changed or deleted. Producers then only need to send what changes.
+    '''
+
+    def __init__(self):
+        self._id_to_object = {}
+
+    def apply(self, edits):
+        ''' Apply the given edits, and return a list of the boxes around everything that they changed, both before
+            and after
+        '''
+        changed_boxes = []
+        for edit in edits:
+            old_object = self._id_to_object.get(edit.object_id)
+            if edit.command == 'delete':
+                if old_object is not None:
+                    del self._id_to_object[edit.object_id]
+                    changed_boxes.append(old_object.box)
+                continue
+
+            if edit.command == 'update':
+                if old_object is None:
+                    continue
+                command, pen = old_object.command, old_object.pen
+            else:
+                command, pen = edit.command, edit.pen
+            handler = _COMMAND_HANDLERS[command]
+            retained = handler.retain(handler.arguments(edit.numbers)) if handler.accepts(edit.numbers) else None
+            if retained is None:
+                continue
+
+            if old_object is not None:
+                changed_boxes.append(old_object.box)
+            box, draw = retained
+            self._id_to_object[edit.object_id] = _RetainedObject(command, pen, box, draw)
+            changed_boxes.append(box)
+        return changed_boxes
+
+    def draw(self, painter, visible_box):
+        ''' Draw every object within the visible box '''
+        for retained_object in self._id_to_object.values():
+            if _boxes_intersect(retained_object.box, visible_box):
+                painter.setPen(retained_object.pen)
+                retained_object.draw(painter)
+
+
+class _PreparedFrame(namedtuple('_PreparedFrame', ('drawing', 'bounds', 'image', 'transform', 'scene_edits'))):
+    ''' A complete frame that is ready to be shown, with the box around its contents, its image as rasterized at the
+        given view transform, and its changes to the retained scene. The image is None if the view had nothing to
+        rasterize it for.
+
+        A frame that was abandoned has nothing but its changes to the retained scene, and a drawing of None.
+    '''
+
+
+def _prepare_frame(frame_data, view_state, abandoned):
+    ''' Build the drawing of a complete frame, record its picture, and rasterize it at the given view state, which is
+        (transform, viewport size, pixel width) as returned by StreamGraphicsObject.view_state(). Raise _FrameAbandoned
+        if the abandoned event is set before we are done.
+    '''
+    transform, size, x_pixel_size = view_state
+    drawing = _FrameDrawing(x_pixel_size)
+    try:
+        bounds = drawing.add(frame_data, True, abandoned)
+        _end_drawing_step(abandoned)
+        picture = drawing.picture()
+
+        image = None
+        if transform is not None and not size.isEmpty():
+            _end_drawing_step(abandoned)
+            image = QtGui.QImage(size, QtGui.QImage.Format_ARGB32_Premultiplied)
+            image.fill(QtCore.Qt.transparent)
+            painter = QtGui.QPainter(image)
+            painter.setTransform(transform)
+            painter.drawPicture(0, 0, picture)
+            painter.end()
+    except _FrameAbandoned:
+        return _PreparedFrame(None, None, None, None, drawing.scene_edits)
+    return _PreparedFrame(drawing, bounds, image, transform, drawing.scene_edits)
+
+
+# How many prepared frames we keep, so that a frame that is sent again unchanged needn't be prepared again
+_PREPARED_FRAME_CACHE_SIZE = 8
+
+
+class _FramePreparer(threading.Thread):
+    ''' Prepare complete frames for display on a thread of our own, since painting into pictures and images doesn't need
+        the GUI thread. Frames are prepared in the order they are given, and each is passed to prepared_callback, even
+        if it was abandoned. So that other things can be done in order with the frames, we may also be asked to pass
+        None to prepared_callback once every frame before has been prepared.
+
+        We keep the most recently prepared frames, keyed by the digest of their data. A frame that we have seen before
+        isn't parsed or drawn again, and its image is reused too if the view hasn't changed.
+    '''
+
+    def __init__(self, prepared_callback):
+        super().__init__(daemon=True)
+        self._prepared_callback = prepared_callback
+        self._frames = queue.Queue()
+        # The digest of each frame maps to the view state at which we prepared it, and the prepared frame
+        self._digest_to_prepared = OrderedDict()
+
+    def prepare(self, frame_data, view_state):
+        ''' Queue a complete frame to be prepared at the given view state. Return an event, which can be set to abandon
+            the frame if it is no longer wanted.
+        '''
+        abandoned = threading.Event()
+        self._frames.put((frame_data, view_state, abandoned))
+        return abandoned
+
+    def synchronize(self):
+        ''' Queue a None to be passed to prepared_callback once every frame before it has been prepared '''
+        self._frames.put((None, None, None))
+
+    def run(self):
+        while True:
+            frame_data, view_state, abandoned = self._frames.get()
+            if frame_data is None:
+                self._prepared_callback(None)
+            else:
+                self._prepared_callback(self._prepare(frame_data, view_state, abandoned))
+
+    def _prepare(self, frame_data, view_state, abandoned):
+        ''' Return the prepared frame, from the cache if possible '''
+        digest = frame_digest(frame_data)
+        cached = self._digest_to_prepared.get(digest)
+        if cached is None:
+            prepared = _prepare_frame(frame_data, view_state, abandoned)
+            if prepared.drawing is None:
+                return prepared
+            self._digest_to_prepared[digest] = (view_state, prepared)
+            if len(self._digest_to_prepared) > _PREPARED_FRAME_CACHE_SIZE:
+                self._digest_to_prepared.popitem(last=False)
+            return prepared
+
+        self._digest_to_prepared.move_to_end(digest)
+        prepared_view_state, prepared = cached
+        if prepared_view_state == view_state:
+            return prepared
+        # The drawing may be on display, so it is left to the GUI thread to draw it at the new view state
+        return prepared._replace(image=None, transform=None)
+
 
 class StreamGraphicsObject(QtGui.QGraphicsObject):
     ''' A graphics view that understands streamcanvas protocol '''
     def __init__(self, controller):
         super().__init__()
         self._controller = controller
-        self._frame_data = ''
 
         GraphicsScene.registerObject(self)
 
-        # This will be a list of function calls that expect to be called with the painter object only
-        self._painter_function_calls = []
+        # We want to be told which part of us needs painting, so that we can skip everything outside of it
+        self.setFlag(QtGui.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+        # The frame that we are showing, and the objects that are kept from one frame to the next
+        self._drawing = _FrameDrawing()
+        self._scene = _RetainedScene()
+
+        # The width of a pixel in the view, once we know it
+        self._x_pixel_size = None
+
+        # A complete frame may come with an image of it, rasterized in the background. This is shown for as long as the
+        # view transform is the one at which it was rasterized.
+        self._image = None
+        self._image_transform = None
 
         # The current view rectangle should increase as things are drawn. This is also used as the bounding rectangle,
         # since pyqtgraph setRange appears to do strange things if the bounding rect varies independently of the
         # view rect.
         # We *must* have a default bounding rectangle before we have any data, otherwise Qt will fall over.
+        self._current_view_box = (0, 0, 1, 1)
         self._current_view_rect = QtCore.QRectF(0, 0, 1, 1)
 
-        # Specify the point extent as a QPoint - think of this as a delta that we add and subtract
-        self._point_extent = QtCore.QPointF(OPTIONS.point_extent, OPTIONS.point_extent)
+        # However often the view grows, we only range the view box to it at most once per displayed frame
+        self._last_range_time = None
+        self._range_pending = False
 
-    def paint(self, painter, *args):
-        ''' Draw the current frame (or the subset of it that we have) '''
-        for call in self._painter_function_calls:
-            call(painter)
+    def paint(self, painter, option, *args):
+        ''' Draw the current frame (or the subset of it that we have), and the retained scene over it. Only the parts
+            of them that are within the exposed rectangle are drawn.
+        '''
+        exposed_rect = option.exposedRect.normalized()
+        visible_box = (exposed_rect.left(), exposed_rect.top(), exposed_rect.right(), exposed_rect.bottom())
+
+        # The image is no use once the view has moved since it was rasterized
+        if self._image is not None and painter.transform() != self._image_transform:
+            self._image = None
+
+        if self._image is not None:
+            # The image is already in device pixels
+            painter.save()
+            painter.resetTransform()
+            painter.drawImage(0, 0, self._image)
+            painter.restore()
+        # When zoomed in on a small part of the frame, it is quicker to draw just that part than to replay everything
+        elif self._drawing.complete and self._drawing.mostly_visible(visible_box):
+            painter.drawPicture(0, 0, self._drawing.picture())
+        else:
+            self._drawing.draw(painter, visible_box)
+
+        self._scene.draw(painter, visible_box)
 
     def boundingRect(self):
         ''' Return the bounding rectangle around the contents we are drawing '''
         return self._current_view_rect
 
-    def set_new_frame(self, frame_data):
-        ''' Take data for a new frame '''
-        self._frame_data = frame_data
-        self._update_painter_calls()
-
-    def append_to_existing_frame(self, frame_data):
-        ''' Append the given data to an existing frame '''
-        self._frame_data += ' ' + frame_data
-        self._update_painter_calls()
-
-    def _update_painter_calls(self):
-        ''' Cache the painter function calls that we need to make to redraw the widget '''
-        # Store the limits of everything we plot. This starts out as a null rectangle, which will also be invalid
-        bounds = QtCore.QRectF()
-        calls = []
-        name_to_points_cache = {}
-
-        for command, data in self._command_and_data_pairs():
-
-            # Default to not creating a call -- it will be added to the list only if it is set to a non-None value
-            call = None
-
-            # Set the pen colour. At the moment expects float  RGB values between 0 and 1
-            if command == 'colour':
-                # TODO support other colour types
-                rgbtmp = ([int(float(x)*255) for x in data]+[int(0),int(0),int(0)])[0:3]
-                rgb = (x for x in rgbtmp)
-                pen = pyqtgraph.mkPen(*rgb)
-                call = lambda painter, pen=pen: painter.setPen(pen)
-
-            # Draw a rectangle
-            elif command == 'rect':
-                rect = QtCore.QRectF(*(float(x) for x in data))
-                bounds = bounds.united(rect)
-                call = lambda painter, rect=rect: painter.drawRect(rect)
-
-            # Draw an ellipse
-            elif command == 'ellipse':
-                rect = QtCore.QRectF(*(float(x) for x in data))
-                bounds = bounds.united(rect)
-                call = lambda painter, rect=rect: painter.drawEllipse(rect)
-
-            # Draw a circle defined by centre, and radius
-            elif command == 'circle':
-                x, y = float(data[0]), float(data[1])
-                centre = QtCore.QPointF(x, y)
-                radius = float(data[2])
-                bound_rect = QtCore.QRectF(x - radius, y - radius, 2 * radius, 2 * radius)
-                bounds = bounds.united(bound_rect)
-                call = lambda painter, centre=centre, radius=radius: painter.drawEllipse(centre, radius, radius)
-
-            # Draw a point
-            elif command == 'point':
-                point = QtCore.QPointF(*(float(x) for x in data))
-                bounds = self._unite_rectangle_with_point(bounds, point)
-                call = lambda painter, point=point: painter.drawPoint(point)
-
-            # Draw a multi-segment line
-            elif command == 'line':
-                points = [QtCore.QPointF(float(x), float(y)) for x, y in pairs(data, distinct=True)]
-                for point in points:
-                    bounds = self._unite_rectangle_with_point(bounds, point)
-                call = lambda painter, points=points: painter.drawPolyline(*points)
-
-            # Draw a multi-segment line, closed back to the start
-            elif command == 'lineclosed':
-                points = [QtCore.QPointF(float(x), float(y)) for x, y in pairs(data, distinct=True)]
-                for point in points:
-                    bounds = self._unite_rectangle_with_point(bounds, point)
-                call = lambda painter, points=points: painter.drawPolygon(*points)
-
-            # Pen creation and moving commands
-            elif command == 'pen':
-                name = data.pop(0)
-                points = [QtCore.QPointF(float(x), float(y)) for x, y in pairs(data, distinct=True)]
-                if name not in name_to_points_cache:
-                    name_to_points_cache[name] = []
-                name_to_points_cache[name].extend(points)
-
-            elif command == 'break':
-                name = data.pop(0)
-                # Move the line cache to a unique name
-                unique_name = None
-                while unique_name is None:
-                    candidate_name = str(random.randint(0, 10000000))
-                    if not candidate_name in name_to_points_cache:
-                        unique_name = candidate_name
-                name_to_points_cache[unique_name] = name_to_points_cache[name]
-                del name_to_points_cache[name]
-
-            if call is not None:
-                calls.append(call)
-
-        # Create calls for any pen objects
-        for points in name_to_points_cache.values():
-            for point in points:
-                bounds = self._unite_rectangle_with_point(bounds, point)
-            call = lambda painter, points=points: painter.drawPolyline(*points)
-            calls.append(call)
-
-
-        # Store the calls
-        self._painter_function_calls = calls
-
-        # The current viewing rectangle will only ever be expanded. It starts out as None, at which point we just
-        # set it to what we've been given
-        old_view_rect = self._current_view_rect
-        self._current_view_rect = self._current_view_rect.united(bounds)
-        if old_view_rect != self._current_view_rect:
-            self._controller.win.setRange(self._current_view_rect, padding=0)
+    def view_state(self):
+        ''' Return (transform, viewport size, pixel width) at which a frame should be rasterized to match the view. The
+            transform maps our coordinates to pixels in the viewport, and is None if we are not in a view.
+        '''
+        views = self.scene().views() if self.scene() is not None else []
+        if len(views) == 0:
+            return None, None, self._x_pixel_size
+        view = views[0]
+        return self.deviceTransform(view.viewportTransform()), view.viewport().size(), self._x_pixel_size
+
+    def set_x_pixel_size(self, x_pixel_size):
+        ''' Set the width of a pixel in the view, which has changed with the visible range '''
+        if not 0 < x_pixel_size < math.inf:
+            x_pixel_size = None
+        if x_pixel_size != self._x_pixel_size:
+            self._x_pixel_size = x_pixel_size
+            self._drawing.set_x_pixel_size(x_pixel_size)
+            self.update()
+
+    def set_new_frame(self, frame_data, complete):
+        ''' Take data for a new frame, which is complete if we have all of it.
+
+            Unlike a complete frame, the data is drawn here on the GUI thread in one go, and can't be abandoned, since
+            nothing newer is read until we return. Nor does it need to be, as the gobbler only begins a partial frame
+            when it has no newer complete one, and each part is only as large as the data that has arrived.
+        '''
+        drawing = _FrameDrawing(self._x_pixel_size)
+        bounds = drawing.add(frame_data, complete)
+        self._show(drawing, bounds)
+        self.apply_scene_edits(drawing.scene_edits)
+
+    def append_to_existing_frame(self, frame_data, complete):
+        ''' Append the given data to an existing frame, which is complete if this is the last of it '''
+        bounds = self._drawing.add(frame_data, complete)
+        if bounds is not None:
+            self._image = None
+            self._expand_view(bounds)
+            self.update()
+        self.apply_scene_edits(self._drawing.scene_edits)
+
+    def show_prepared_frame(self, prepared):
+        ''' Show a complete frame that has been prepared in the background. This needn't parse or draw anything. '''
+        self._show(prepared.drawing, prepared.bounds)
+        self._image = prepared.image
+        self._image_transform = prepared.transform
+        self.apply_scene_edits(prepared.scene_edits)
+
+    def apply_scene_edits(self, edits):
+        ''' Make the given changes to the retained scene, and repaint just the regions that they change '''
+        bounds = None
+        for box in self._scene.apply(edits):
+            bounds = _united_boxes(bounds, box)
+            self.update(_box_rect(box))
+        self._expand_view(bounds)
+
+    def _show(self, drawing, bounds):
+        ''' Show the given drawing in place of the current frame '''
+        if drawing.x_pixel_size != self._x_pixel_size:
+            drawing.set_x_pixel_size(self._x_pixel_size)
+        # If neither frame draws anything outside of the retained scene, there is nothing to repaint
+        if drawing.content_box is not None or self._drawing.content_box is not None:
+            self.update()
+        self._drawing = drawing
+        self._image = None
+        self._expand_view(bounds)
+
+    def _expand_view(self, bounds):
+        ''' Expand the view to include the given box, which may be None '''
+        # The current viewing rectangle will only ever be expanded
+        old_view_box = self._current_view_box
+        if bounds is None or _united_boxes(old_view_box, bounds) == old_view_box:
+            return
+        self._current_view_box = _grown_box(old_view_box, bounds, OPTIONS.range_growth_margin)
+        self.prepareGeometryChange()
+        self._current_view_rect = _box_rect(self._current_view_box)
 
         # sc_print(self._current_view_rect)
 
-    def _unite_rectangle_with_point(self, rect, point):
-        ''' Given a Qt rectangle, return the expanded rectangle that contains this point. If the rectangle already
-            contains the point return the same object.
-        '''
-        point_extent_rect = QtCore.QRectF(point - self._point_extent, point + self._point_extent)
-        return rect.united(point_extent_rect)
-
-    def _command_and_data_pairs(self):
-        ''' Split the current frame data into pairs and yield in the form of (command, data). For example:
+        if self._range_pending:
+            return
+        time_to_wait = 0
+        if self._last_range_time is not None:
+            time_to_wait = 1 / OPTIONS.max_frame_rate - (time.perf_counter() - self._last_range_time)
+        if time_to_wait <= 0:
+            self._apply_range()
+        else:
+            self._range_pending = True
+            QtCore.QTimer.singleShot(int(time_to_wait * 1000), self._apply_range)
 
-            circle[0 0 1]   --> ('circle', ['0', '0', '1'])
-            reset_pen[]     --> ('reset_pen', [])
+    def _apply_range(self):
+        ''' Range the view box to the current view rectangle '''
+        self._range_pending = False
+        self._last_range_time = time.perf_counter()
+        self._controller.win.setRange(self._current_view_rect, padding=0)
 
-            We don't support commands without arguments, e.g. "reset_pen", since this creates ambiguity when we have
-            a partial frame -- we could return ('circle', None), and we don't want the caller to have to deal with this
-            case for every command.
-        '''
-        # Split at spaces (outside of brackets) or at brackets themselves
-        # TODO removing newlines completely may not be desired, we could perhaps do better
-        frame_data = self._frame_data.replace('\n', ' ')
-        tokens = [token for token in re.split("( |\[.*?\])", frame_data) if token.strip()]
-
-        command = None
-        data = None
-        for token in tokens:
-            # If command would be an end of frame, we should definitely stop. If data would be an end of frame
-            # we ignore the command, since we expect every command to have some data associated with it
-            if token == TOKEN_END_OF_FRAME:
-                break
-
-            if command is None:
-                # We need a new command
-                command = token
-                continue
-            elif data is None:
-                token = token.lstrip('[').rstrip(']')
-                data = [piece for piece in re.split("( |\\\".*?\\\"|'.*?')", token) if piece.strip()]
 
-            if command is not None and data is not None:
-                yield command, data
-                command = data = None
+class _ThreadRelay(QtCore.QObject):
+    ''' Carries objects from another thread (such as responses from the thread on which they are read) to the GUI
+        thread
+    '''
 
+    received = QtCore.Signal(object)
 
 
 class StreamCanvasGUI:
-    ''' The GUI used by stream canvas - holds the Qt application and window, and performs periodic updates. '''
+    ''' The GUI used by stream canvas - holds the Qt application and window, and performs periodic updates.
+
+        Responses from the gobbler are read on a separate thread, so the GUI stays responsive while a large frame
+        arrives. Since the gobbler responds to signals in the order that they were sent, we keep the function that
+        should handle each response in the same order.
+
+        Complete frames are prepared on another thread too, and shown once they are ready. While we are inspecting a
+        complete frame without dropping, we fetch and prepare the next one in advance, so that advancing to it is
+        instant. When dropping, we only fetch the next frame once we advance, since it would be stale by then. In live
+        mode we carry on asking for frames while one is prepared, and abandon it if a newer complete one arrives, so
+        that we keep up with the stream however long a frame takes to prepare. So that we always make progress, a frame
+        that has waited longer than a frame interval is shown whatever arrives, and we ask for no more until it is.
+    '''
 
     def __init__(self):
         self._last_response = RESPONSE_NO_NEXT_FRAME        # Initialise thus so we request a full frame next
+        self._last_update_time = None
+        self._response_handlers = deque()
+        self._frame_requested = False
+
+        # Set if we were asked to update but couldn't, in which case we do so once we can
+        self._update_missed = False
+
+        # Frames are prepared in the order they are given, so we handle them in the same order as responses
+        self._prepared_frame_handlers = deque()
+
+        # The event that abandons the frame being prepared for display, if there is one, and when we started on it
+        self._display_preparation = None
+        self._display_preparation_time = None
+
+        # The next frame, fetched while inspecting the current one, as (response, data). The data of a complete frame
+        # is its prepared form.
+        self._prefetched = None
+        self._prefetching = False
+        self._advance_when_prefetched = False
+
+        # Set if we were asked to catch up while the gobbler was part way through delivering a frame
+        self._catch_up_when_received = False
+
         self._create_window()
         self._populate_gui()
         self._start_updates()
@@ -276,38 +1211,159 @@ class StreamCanvasGUI:
         self.grid_item = pyqtgraph.GridItem()
         self.view_box.addItem(self.grid_item)
 
+        # How much we decimate long polylines depends on the width of a pixel
+        self.view_box.sigXRangeChanged.connect(self._on_view_changed)
+        self.view_box.sigResized.connect(self._on_view_changed)
+
+    def _on_view_changed(self, *args):
+        ''' Tell the graphics object how wide a pixel now is '''
+        self.stream_graphics_object.set_x_pixel_size(self.view_box.viewPixelSize()[0])
+
     def _start_updates(self):
-        ''' Start the timer-based updating of view contents'''
+        ''' Start updating the view contents, either periodically or whenever the gobbler tells us of new data '''
+        # This must happen before we start reading responses on another thread
+        if OPTIONS.update is UpdateMode.push:
+            self._notify_fd = enable_new_data_notifications()
+
+        self._response_relay = _ThreadRelay()
+        self._response_relay.received.connect(self._on_response)
+        self._response_reader = ResponseReader(self._response_relay.received.emit)
+        self._response_reader.start()
+
+        self._prepared_frame_relay = _ThreadRelay()
+        self._prepared_frame_relay.received.connect(self._on_prepared_frame)
+        self._frame_preparer = _FramePreparer(self._prepared_frame_relay.received.emit)
+        self._frame_preparer.start()
+
         self.timer = QtCore.QTimer()
         self.timer.timeout.connect(self.update)
-        self.timer.start(OPTIONS.window_update_time_ms)
+        if OPTIONS.update is UpdateMode.timer:
+            self.timer.start(OPTIONS.window_update_time_ms)
+            return
+
+        # The timer is only used to delay updates that would exceed the maximum frame rate
+        self.timer.setSingleShot(True)
+        self.notifier = QtCore.QSocketNotifier(self._notify_fd, QtCore.QSocketNotifier.Read)
+        self.notifier.activated.connect(self._on_new_data_notification)
+
+    def _on_new_data_notification(self):
+        ''' The gobbler has new data, so update now, or as soon as the maximum frame rate allows '''
+        if len(os.read(self._notify_fd, 64)) == 0:
+            # The gobbler has gone away, so shut down
+            self.notifier.setEnabled(False)
+            self.app.quit()
+            return
+        self._schedule_update()
+
+    def _schedule_update(self):
+        ''' Update now, or as soon as the maximum frame rate allows '''
+        if self.timer.isActive():
+            return
+        time_to_wait = 1 / OPTIONS.max_frame_rate
+        if self._last_update_time is not None:
+            time_to_wait -= time.perf_counter() - self._last_update_time
+        if time_to_wait <= 0:
+            self.update()
+        else:
+            self.timer.start(int(time_to_wait * 1000))
 
     def update(self):
         ''' Create new frames '''
         mode = OPTIONS.mode
 
-        # If we're in inspect modes, we shouldn't advance to the next frame in an update
+        # We'll ask again once we have the data we asked for last time, or have shown a frame that has waited too long
+        if self._frame_requested or self._display_preparation_overdue():
+            self._update_missed = True
+            return
+
+        # If we're in inspect modes, we shouldn't advance to the next frame in an update. Without dropping, the next
+        # frame is fixed, so we can get it ready, but when dropping we want whatever is newest once we advance.
         if (mode in (DisplayMode.inspect_nodrop, DisplayMode.inspect_drop)
                 and self._last_response in (RESPONSE_COMPLETE_FRAME, RESPONSE_END_PARTIAL_FRAME)):
+            if mode is DisplayMode.inspect_drop:
+                return
+            if self._prefetched is None:
+                self._prefetch_next_frame()
+            else:
+                # We'll want the frame after this one once we advance
+                self._update_missed = True
+            return
+
+        # We may have switched to live mode with a frame already fetched
+        if self._prefetched is not None:
+            self._show_prefetched_frame()
+            self._update_if_missed()
             return
 
         self._request_frame_data()
 
     def request_frame_advance(self):
-        ''' If we are currently in possession of a complete frame, request a new one. Return True if we did get a new
-            frame, False otherwise
+        ''' If we are currently in possession of a complete frame, request a new one. Return True if we did request a
+            new frame, False otherwise
         '''
         # We haven't got a complete frame yet, try again later
         if self._last_response not in (RESPONSE_COMPLETE_FRAME, RESPONSE_END_PARTIAL_FRAME):
             return False
 
+        # If we already have the next frame then we just show it, and if we are fetching it we show it once it's ready
+        if self._prefetched is not None:
+            self._show_prefetched_frame()
+            self._update_if_missed()
+            return True
+        if self._prefetching:
+            self._advance_when_prefetched = True
+            return True
+
+        if self._frame_requested:
+            return False
+
         self._request_frame_data()
 
-        # Return True to indicate that we advanced the frame
+        # Return True to indicate that we are advancing the frame
         return True
 
+    def request_catch_up(self):
+        ''' Tell the gobbler to discard all but its most recent complete frame, and then advance to it. Return True if
+            we did ask to catch up, False otherwise
+        '''
+        # As with advancing, we can't do this until we have finished receiving the current frame
+        if self._frame_requested or self._last_response not in (RESPONSE_COMPLETE_FRAME, RESPONSE_END_PARTIAL_FRAME):
+            return False
+
+        # If the next frame is partial, the gobbler is part way through delivering it, and can't skip it. We advance to
+        # it, and catch up once we have received all of it.
+        if self._prefetched is not None and self._prefetched[0] == RESPONSE_BEGIN_PARTIAL_FRAME:
+            self._catch_up_when_received = True
+            self._show_prefetched_frame()
+            self.update()
+            return True
+
+        # A complete frame that we fetched in advance is no longer the most recent, but we keep its changes to the
+        # retained scene
+        if self._prefetched is not None:
+            self.stream_graphics_object.apply_scene_edits(self._prefetched[1].scene_edits)
+        self._prefetched = None
+
+        def on_acknowledge(response, data):
+            self._check_acknowledged(response)
+            self.request_frame_advance()
+
+        self._send_signal(SIGNAL_CATCH_UP, on_acknowledge)
+        return True
+
+    def update_gobbler_dropping_mode(self):
+        ''' Send a signal to the gobbler based on the current options '''
+        self._send_signal(dropping_mode_signal(), lambda response, data: self._check_acknowledged(response))
+
+    def _check_acknowledged(self, response):
+        ''' Raise an error if the given response is not an acknowledgement '''
+        if response != RESPONSE_ACKNOWLEDGE:
+            raise RuntimeError("Expected acknowledge, got '{}'".format(response))
+
     def _request_frame_data(self):
-        ''' Perform the request to the gobbler, and apply the updates to the canvas '''
+        ''' Perform the request to the gobbler. The updates are applied to the canvas once they arrive. '''
+        self._last_update_time = time.perf_counter()
+
         # We request a complete frame if we have already received a complete frame, otherwise we try to finish
         # the frame that we started
         if self._last_response in (RESPONSE_COMPLETE_FRAME, RESPONSE_END_PARTIAL_FRAME, RESPONSE_NO_NEXT_FRAME):
@@ -315,33 +1371,188 @@ class StreamCanvasGUI:
         else:
             signal = SIGNAL_MORE_OF_SAME_FRAME
 
-        response, data = self._read_response_and_data(signal)
+        self._frame_requested = True
+        self._send_signal(signal, self._on_frame_data)
 
-        # Either start a fresh frame, or append to existing data as appropriate
-        if response in (RESPONSE_COMPLETE_FRAME, RESPONSE_BEGIN_PARTIAL_FRAME):
-            self.stream_graphics_object.set_new_frame(data)
-        elif response in (RESPONSE_CONTINUE_PARTIAL_FRAME, RESPONSE_END_PARTIAL_FRAME):
-            self.stream_graphics_object.append_to_existing_frame(data)
-        # Do nothing in the case that there wasn't any more data to give us
+    def _on_frame_data(self, response, data):
+        ''' Show the frame data that we requested. A complete frame is prepared in the background first. In live mode
+            we may then ask for a newer frame to take its place, and otherwise we count it as requested until it is
+            shown.
+        '''
+        if response != RESPONSE_COMPLETE_FRAME:
+            self._frame_requested = False
+            self._apply_frame_data(response, data)
+            return
+
+        live = OPTIONS.mode is DisplayMode.live
+        if live:
+            self._frame_requested = False
+
+        def on_prepared(prepared):
+            if not live:
+                self._frame_requested = False
+            # The frame may have been abandoned too late to stop it being prepared
+            if abandoned.is_set():
+                self.stream_graphics_object.apply_scene_edits(prepared.scene_edits)
+                return
+            # A newer frame may be being prepared after this one, which we leave alone
+            if self._display_preparation is abandoned:
+                self._display_preparation = None
+            self._show_prepared_frame(prepared)
+
+        # This frame is newer than any being prepared, which we needn't show unless it has already waited too long
+        if not self._display_preparation_overdue():
+            self._abandon_display_preparation()
+        abandoned = self._display_preparation = self._prepare_frame(data, on_prepared)
+        self._display_preparation_time = time.perf_counter()
+
+    def _abandon_display_preparation(self):
+        ''' Abandon the frame being prepared for display, if there is one, since something newer is to be shown '''
+        if self._display_preparation is not None:
+            self._display_preparation.set()
+            self._display_preparation = None
+
+    def _display_preparation_overdue(self):
+        ''' Return True iff the frame being prepared for display has waited longer than a frame interval, in which case
+            it must be shown rather than abandoned
+        '''
+        if self._display_preparation is None:
+            return False
+        if OPTIONS.update is UpdateMode.timer:
+            frame_interval = OPTIONS.window_update_time_ms / 1000
+        else:
+            frame_interval = 1 / OPTIONS.max_frame_rate
+        return time.perf_counter() - self._display_preparation_time > frame_interval
+
+    def _prefetch_next_frame(self):
+        ''' Fetch the next frame, and prepare it if it is complete, ready for when we advance to it '''
+        self._frame_requested = True
+        self._prefetching = True
+        self._send_signal(SIGNAL_NEXT_FRAME, self._on_prefetched_frame_data)
+
+    def _on_prefetched_frame_data(self, response, data):
+        ''' Keep the next frame until we advance to it '''
+        if response == RESPONSE_COMPLETE_FRAME:
+            self._prepare_frame(data, lambda prepared: self._finish_prefetch((response, prepared)))
+        elif response == RESPONSE_NO_NEXT_FRAME:
+            self._finish_prefetch(None)
+        else:
+            # The start of a partial frame is shown progressively once we advance to it
+            self._finish_prefetch((response, data))
+
+    def _finish_prefetch(self, prefetched):
+        ''' Keep what was prefetched, which is None if there was no next frame, and show it if we've already been asked
+            to advance
+        '''
+        self._frame_requested = False
+        self._prefetching = False
+        self._prefetched = prefetched
+        advance = self._advance_when_prefetched
+        self._advance_when_prefetched = False
+        if advance and prefetched is not None:
+            self._show_prefetched_frame()
+
+    def _show_prefetched_frame(self):
+        ''' Show the frame that we fetched in advance '''
+        self._last_update_time = time.perf_counter()
+        response, data = self._prefetched
+        self._prefetched = None
+        self._abandon_display_preparation()
+        if response == RESPONSE_COMPLETE_FRAME:
+            self._show_prepared_frame(data)
+        else:
+            self._apply_frame_data(response, data)
+
+    def _prepare_frame(self, frame_data, prepared_handler):
+        ''' Prepare a complete frame in the background at the current view state. Once it is ready, prepared_handler is
+            called with it on this thread, unless it is abandoned first. Return the event that abandons it.
+        '''
+        self._prepared_frame_handlers.append(prepared_handler)
+        return self._frame_preparer.prepare(frame_data, self.stream_graphics_object.view_state())
+
+    def _after_preparations(self, function):
+        ''' Call function once every frame that is being prepared has been handled '''
+        if len(self._prepared_frame_handlers) == 0:
+            function()
+            return
+        self._prepared_frame_handlers.append(lambda prepared: function())
+        self._frame_preparer.synchronize()
+
+    def _on_prepared_frame(self, prepared):
+        ''' Pass a prepared frame to whatever was waiting for it. If it was abandoned, we still make its changes to the
+            retained scene.
+        '''
+        prepared_handler = self._prepared_frame_handlers.popleft()
+        if prepared is not None and prepared.drawing is None:
+            self.stream_graphics_object.apply_scene_edits(prepared.scene_edits)
+        else:
+            prepared_handler(prepared)
+        self._update_if_missed()
 
+    def _show_prepared_frame(self, prepared):
+        ''' Swap in a complete frame that has been prepared in the background '''
+        self.stream_graphics_object.show_prepared_frame(prepared)
+        self._last_response = RESPONSE_COMPLETE_FRAME
+        self.view_box.update()
+
+    def _apply_frame_data(self, response, data):
+        ''' Apply the given partial frame data to the canvas. This waits for any frames that are being prepared, so
+            that every frame's changes to the retained scene are made in the order that the frames arrived. A complete
+            frame being prepared is still shown first, since the gobbler only starts a partial frame when it has no
+            newer complete one.
+        '''
         # We save the last response so we know what to request next time
         self._last_response = response
 
+        self._after_preparations(lambda: self._draw_frame_data(response, data))
+
+        # We may have been waiting to finish this frame before catching up
+        if response == RESPONSE_END_PARTIAL_FRAME and self._catch_up_when_received:
+            self._catch_up_when_received = False
+            if OPTIONS.mode is DisplayMode.inspect_nodrop:
+                self.request_catch_up()
+
+    def _draw_frame_data(self, response, data):
+        ''' Draw the given partial frame data '''
+        # Either start a fresh frame, or append to existing data as appropriate
+        if response == RESPONSE_BEGIN_PARTIAL_FRAME:
+            self.stream_graphics_object.set_new_frame(data, complete=False)
+        elif response in (RESPONSE_CONTINUE_PARTIAL_FRAME, RESPONSE_END_PARTIAL_FRAME):
+            self.stream_graphics_object.append_to_existing_frame(data, response == RESPONSE_END_PARTIAL_FRAME)
+        # Do nothing in the case that there wasn't any more data to give us
+
         # Make sure we can see the updates!
         self.view_box.update()
 
-    def _read_response_and_data(self, signal):
-        ''' Send signal to the parent process, and return the response code and data that we receive back '''
-        # Indicate that we want the next frame
+    def _send_signal(self, signal, response_handler):
+        ''' Send signal to the parent process. Once its response arrives, response_handler is called with the response
+            code and data.
+        '''
+        self._response_handlers.append(response_handler)
         try:
-            response, data = read_response_and_data(signal)
+            send_signal(signal)
         except BrokenPipeError:
             # If the gobbler has broken, shut down
             self.app.quit()
-            return None, None
-        return response, data
+
+    def _on_response(self, response_and_data):
+        ''' Pass a response that has been received in full to whatever was waiting for it '''
+        if response_and_data is None:
+            # The gobbler has gone away, so shut down
+            self.app.quit()
+            return
+        self._response_handlers.popleft()(*response_and_data)
+        self._update_if_missed()
+
+    def _update_if_missed(self):
+        ''' Update if we were asked to when we couldn't. With push updates we must, since the gobbler won't tell us of
+            new data again until we have asked for some.
+        '''
+        if not self._update_missed or OPTIONS.update is not UpdateMode.push:
+            return
+        self._update_missed = False
+        self._schedule_update()
 
     def run(self):
         ''' Start the application '''
         self.app.exec_()
-
@@ -0,0 +1,288 @@
+''' Splitting of the input stream into tokens, which can be fed arbitrarily sized chunks of text '''
+
+import re
+
+from collections import namedtuple
+
+from streamcanvas.constants import TOKEN_END_OF_FRAME
+
+
+# Separators of tokens
+_SEPARATORS = (' ', '\n', '\t')
+
+# We ignore everything that is within a comment.
+_COMMENT_START = '#'
+_COMMENT_END = '\n'
+
+# When we're within a delimiter pair we keep absorbing the token
+_OPENING_TO_CLOSING_DELIMITER = {'(': ')', '[': ']', '{': '}', '"': '"', "'": "'"}
+_STRING_DELIMITERS = ('"', "'")
+
+# The characters that can change the state of the tokenizer. Outside of any delimiter pair separators end a token, but
+# within a pair we only care about comments and further delimiters.
+_SPECIAL_OUTSIDE_DELIMITERS = re.compile(r'''[ \n\t#()\[\]{}"']''')
+_SPECIAL_WITHIN_DELIMITERS = re.compile(r'''[#()\[\]{}"']''')
+
+
+class _ScannerSyntax(namedtuple('_ScannerSyntax', ('empty', 'comment_start', 'comment_end', 'comment_or_string_starts',
+                                                   'end_of_frame', 'opening_delimiters', 'closing_delimiters'))):
+    ''' The pieces of syntax that the frame scanner needs, in the form of either str or bytes '''
+
+    @classmethod
+    def create(cls, convert):
+        ''' Create the syntax, where convert turns a str into the required type '''
+        return cls(empty=convert(''),
+                   comment_start=convert(_COMMENT_START),
+                   comment_end=convert(_COMMENT_END),
+                   # When scanning, these are the only characters that stop us counting delimiters in bulk
+                   comment_or_string_starts=tuple(convert(character) for character in '#"\''),
+                   # The end-of-frame token only counts if it stands alone, i.e. it is preceded by a separator (or the
+                   # start of the stream) and followed by a separator or a comment. We check what precedes the token
+                   # only after matching it, which lets the regex engine search quickly for the token itself.
+                   end_of_frame=re.compile(convert(r'{0}(?<![^ \n\t]{0})(?=[ \n\t#])'.format(
+                       re.escape(TOKEN_END_OF_FRAME)))),
+                   opening_delimiters=tuple(convert(delimiter) for delimiter in '([{'),
+                   closing_delimiters=tuple(convert(delimiter) for delimiter in ')]}'))
+
+_TEXT_SYNTAX = _ScannerSyntax.create(str)
+# Since all of the syntax is ASCII, we can scan UTF-8 encoded bytes in exactly the same way
+_BYTES_SYNTAX = _ScannerSyntax.create(lambda text: text.encode('ascii'))
+
+
+class Tokenizer:
+    ''' Split text from the input stream into tokens, and pass each one to token_callback as soon as it is complete.
+
+        Text may be fed in chunks of any size. Whether we are in a comment, a string or a delimiter pair, along with any
+        partially read token, is remembered from one call of feed() to the next.
+
+        If token_callback returns True, we stop tokenizing immediately after that token, leaving the tokenizer in its
+        initial state. feed() returns how much of the text was consumed, so that the caller can deal with the rest.
+    '''
+
+    def __init__(self, token_callback):
+        self._token_callback = token_callback
+
+        # For clarity, we keep state information about being in comments separate from the delimiter pair stack.
+        self._in_comment = False
+
+        # Whenever we see an opening delimiter, we push it onto the stack.
+        self._delimiter_stack = []
+
+        # The pieces of the token that we are currently building, joined only once the token is complete
+        self._pieces = []
+
+    def feed(self, text):
+        ''' Tokenize the given chunk of text, emitting every token that is completed within it. Return the number of
+            characters consumed, which is all of them unless we were told to stop.
+        '''
+        pieces = self._pieces
+        delimiter_stack = self._delimiter_stack
+        position = 0
+        length = len(text)
+
+        while position < length:
+            # If we're in a comment, skip straight to the end-of-comment indicator.
+            if self._in_comment:
+                end = text.find(_COMMENT_END, position)
+                if end == -1:
+                    return length
+                self._in_comment = False
+                position = end + 1
+                # A comment within a delimiter pair behaves like any other whitespace there
+                if len(delimiter_stack) > 0:
+                    pieces.append(' ')
+                continue
+
+            # If we're within a string, we are happy to absorb any old rubbish up to the closing quote. We make the
+            # assumption that you close the string with the same type of quote with which it was opened.
+            if len(delimiter_stack) > 0 and delimiter_stack[-1] in _STRING_DELIMITERS:
+                end = text.find(delimiter_stack[-1], position)
+                if end == -1:
+                    pieces.append(text[position:])
+                    return length
+                pieces.append(text[position:end + 1])
+                delimiter_stack.pop()
+                position = end + 1
+                continue
+
+            # Otherwise absorb everything up to the next character that we need to look at more carefully
+            special_characters = _SPECIAL_WITHIN_DELIMITERS if delimiter_stack else _SPECIAL_OUTSIDE_DELIMITERS
+            match = special_characters.search(text, position)
+            if match is None:
+                pieces.append(text[position:])
+                return length
+            index = match.start()
+            if index > position:
+                pieces.append(text[position:index])
+            position = index + 1
+            character = text[index]
+
+            # The start of a comment also ends any token outside of delimiters. If we are told to stop, we leave the
+            # comment start to be consumed by the caller.
+            if character == _COMMENT_START:
+                if len(delimiter_stack) == 0 and self._flush():
+                    return index
+                self._in_comment = True
+
+            # We have a separator, and we're not within a delimiter pair! Flush the complete token.
+            elif character in _SEPARATORS:
+                if self._flush():
+                    return index
+
+            # We have an opening delimiter (note that we can't be closing a string here). We push it onto the stack,
+            # but also let it be added to the token.
+            elif character in _OPENING_TO_CLOSING_DELIMITER:
+                delimiter_stack.append(character)
+                pieces.append(character)
+
+            # We have a closing delimiter!
+            else:
+                if len(delimiter_stack) == 0 or _OPENING_TO_CLOSING_DELIMITER[delimiter_stack[-1]] != character:
+                    raise RuntimeError("Unmatched closing delimiter {} in '{}'".format(character, ''.join(pieces)))
+                # We know this is the correct delimiter, so pop it off the stack
+                delimiter_stack.pop()
+                pieces.append(character)
+
+        return length
+
+    def finish(self):
+        ''' Indicate that the input has ended, so whatever we have is the final token. The tokenizer is then reset. '''
+        self._flush()
+        self._in_comment = False
+        del self._delimiter_stack[:]
+
+    def _flush(self):
+        ''' Emit the token that we have built up so far, if any. Return True iff we have been asked to stop. '''
+        if len(self._pieces) == 0:
+            return False
+        token = ''.join(self._pieces)
+        del self._pieces[:]
+        return self._token_callback(token)
+
+
+def tokenize_frame(text):
+    ''' Return the tokens in the given text, which must contain whole frames, separated by spaces. Tokenizing text
+        that has already been tokenized in this way leaves it unchanged.
+    '''
+    tokens = []
+    tokenizer = Tokenizer(tokens.append)
+    tokenizer.feed(text)
+    tokenizer.finish()
+    return join_tokens(tokens)
+
+
+def join_tokens(tokens):
+    ''' Join a list of tokens into the string form in which frames are stored and sent, with each token preceded by
+        a space
+    '''
+    if len(tokens) == 0:
+        return ''
+    return ' ' + ' '.join(tokens)
+
+
+class FrameScanner:
+    ''' Find where frames end in text from the input stream, without tokenizing it.
+
+        We must still respect comments and strings, and an end-of-frame token within a delimiter pair doesn't count.
+        However, between comments and strings we only need to count delimiters, which we can do in bulk. Text may be
+        given in chunks of any size, and offsets are counted from the start of all the text given to the scanner.
+
+        If binary is True we scan UTF-8 encoded bytes rather than str, and offsets are counted in bytes.
+    '''
+
+    def __init__(self, binary=False):
+        self._syntax = _BYTES_SYNTAX if binary else _TEXT_SYNTAX
+        self._in_comment = False
+        self._string_delimiter = None
+        self._depth = 0
+
+        # We hold back the end of each chunk, since it might contain the start of an end-of-frame token. The first
+        # _num_scanned characters of this have already been scanned, but we keep them to see what precedes a token.
+        self._held_back = self._syntax.empty
+        self._held_back_offset = 0
+        self._num_scanned = 0
+
+    def scan(self, text):
+        ''' Scan the next chunk of text, and return the offsets just after each end-of-frame token found '''
+        text = self._held_back + text
+        # Leave enough characters to be sure of what follows any end-of-frame token that we find
+        return self._scan(text, len(text) - len(TOKEN_END_OF_FRAME))
+
+    def finish(self):
+        ''' Indicate that the input has ended, and return the offsets of any frame ends in what we held back '''
+        return self._scan(self._held_back + self._syntax.comment_end, len(self._held_back) + 1)
+
+    def _scan(self, text, scan_end):
+        ''' Scan text up to scan_end, and hold back the remainder '''
+        syntax = self._syntax
+        frame_ends = []
+        offset = self._held_back_offset
+        if scan_end <= self._num_scanned:
+            self._held_back = text
+            return frame_ends
+
+        # The next occurrence of each character that starts a comment or string. We search for each of these separately
+        # since that is much quicker than searching for a character class, and only search again once we have passed it.
+        next_starts = [-1] * len(syntax.comment_or_string_starts)
+
+        position = self._num_scanned
+        while position < scan_end:
+            # Everything in a comment or string is ignored
+            if self._in_comment or self._string_delimiter is not None:
+                closing = syntax.comment_end if self._in_comment else self._string_delimiter
+                end = text.find(closing, position, scan_end)
+                if end == -1:
+                    break
+                self._in_comment = False
+                self._string_delimiter = None
+                position = end + 1
+                continue
+
+            plain_end = scan_end
+            for index, start_character in enumerate(syntax.comment_or_string_starts):
+                if next_starts[index] < position:
+                    next_start = text.find(start_character, position, scan_end)
+                    next_starts[index] = scan_end if next_start == -1 else next_start
+                plain_end = min(plain_end, next_starts[index])
+
+            self._scan_plain(text, position, plain_end, offset, frame_ends)
+            if plain_end == scan_end:
+                break
+            # Slicing rather than indexing gives us a character in the same form whether we have str or bytes
+            character = text[plain_end:plain_end + 1]
+            if character == syntax.comment_start:
+                self._in_comment = True
+            else:
+                self._string_delimiter = character
+            position = plain_end + 1
+
+        self._held_back = text[scan_end - 1:]
+        self._held_back_offset = offset + scan_end - 1
+        self._num_scanned = 1
+        return frame_ends
+
+    def _scan_plain(self, text, start, end, offset, frame_ends):
+        ''' Scan text between start and end that contains no comments or strings, where we need only keep track of the
+            depth of delimiter pairs
+        '''
+        depth = self._depth
+        # Matches must start before the end, but we may look just beyond it to see what follows the token
+        search_end = min(end + len(TOKEN_END_OF_FRAME) + 1, len(text))
+        for match in self._syntax.end_of_frame.finditer(text, start, search_end):
+            if match.start() >= end:
+                break
+            depth += self._delimiter_depth_change(text, start, match.start())
+            start = match.start()
+            if depth == 0:
+                frame_ends.append(offset + match.end())
+        self._depth = depth + self._delimiter_depth_change(text, start, end)
+        if self._depth < 0:
+            raise RuntimeError("Unmatched closing delimiter in '{}'".format(text[start:end]))
+
+    def _delimiter_depth_change(self, text, start, end):
+        ''' Return the change in delimiter depth between start and end in some text containing no strings '''
+        round_, square, curly = self._syntax.opening_delimiters
+        round_end, square_end, curly_end = self._syntax.closing_delimiters
+        return (text.count(round_, start, end) + text.count(square, start, end) + text.count(curly, start, end)
+                - text.count(round_end, start, end) - text.count(square_end, start, end)
+                - text.count(curly_end, start, end))
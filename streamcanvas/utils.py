@@ -25,11 +25,15 @@ def pairs(iterable, skip=1, distinct=False):
     else:
         def _distinct_generator(iter_):
             # Ensure that we have an iterator object
+            iter_ = iter(iter_)
             while True:
-                iter_ = iter(iter_)
-                item_0 = next(iter_)
-                for _ in range(skip):
-                    item_1 = next(iter_)
+                try:
+                    item_0 = next(iter_)
+                    for _ in range(skip):
+                        item_1 = next(iter_)
+                except StopIteration:
+                    # A generator mustn't let StopIteration escape, so we finish explicitly
+                    return
                 yield item_0, item_1
 
         return _distinct_generator(iterable)
@@ -0,0 +1,90 @@
+''' Tests of sending messages from the gobbler to the plotter in the binary and shared memory protocols '''
+
+import io
+import os
+import threading
+import unittest
+
+from unittest import mock
+
+from streamcanvas import communication
+from streamcanvas.communication import BinaryReceiver, SharedMemorySender, send_response_and_data, shared_memory
+from streamcanvas.options import Protocol
+
+
+class _PipeTest(unittest.TestCase):
+    ''' Sends messages down a pipe on another thread, so that large ones can't fill the pipe while we wait '''
+
+    def setUp(self):
+        read_fd, write_fd = os.pipe()
+        self.reader = io.FileIO(read_fd, 'r')
+        self.writer = io.FileIO(write_fd, 'w')
+        self.addCleanup(self.reader.close)
+
+    def send(self, send_function, messages):
+        ''' Send each (response, data) with send_function(stream, response, data), and then close the pipe '''
+        def send_all():
+            with self.writer:
+                for response, data in messages:
+                    send_function(self.writer, response, data)
+        thread = threading.Thread(target=send_all)
+        thread.start()
+        self.addCleanup(thread.join)
+
+
+class BinaryProtocolTest(_PipeTest):
+
+    def test_messages_arrive_in_order(self):
+        messages = [('a', ''), ('b', ' point[1 1] approve'), ('c', ' text[é] approve')]
+        self.send(lambda stream, response, data: send_response_and_data(stream, response, data, Protocol.binary),
+                  messages)
+        receiver = BinaryReceiver(self.reader.fileno())
+        self.assertEqual([receiver.read_message() for _ in messages], messages)
+
+    def test_buffer_grows_to_fit_large_messages(self):
+        large = ' point[1 1]' * 100000
+        messages = [('a', 'small'), ('b', large), ('c', 'small again')]
+        self.send(lambda stream, response, data: send_response_and_data(stream, response, data, Protocol.binary),
+                  messages)
+        receiver = BinaryReceiver(self.reader.fileno())
+        self.assertEqual([receiver.read_message() for _ in messages], messages)
+
+    def test_raw_responses_are_bytes(self):
+        self.send(lambda stream, response, data: send_response_and_data(stream, response, data, Protocol.binary),
+                  [('a', b'\x00\xff'), ('b', 'text')])
+        receiver = BinaryReceiver(self.reader.fileno())
+        receiver.raw_responses = frozenset('a')
+        self.assertEqual(receiver.read_message(), ('a', b'\x00\xff'))
+        self.assertEqual(receiver.read_message(), ('b', 'text'))
+
+    def test_closed_pipe_is_an_error(self):
+        self.send(lambda stream, response, data: None, [])
+        receiver = BinaryReceiver(self.reader.fileno())
+        with self.assertRaises(BrokenPipeError):
+            receiver.read_message()
+
+
+@unittest.skipIf(shared_memory is None, 'Shared memory is not available')
+class SharedMemoryProtocolTest(_PipeTest):
+
+    def setUp(self):
+        super().setUp()
+        # The receiver would normally be another process, which leaves the sender's segments registered to the sender.
+        # Here they are the same process, so the receiver mustn't unregister them before the sender unlinks them.
+        patcher = mock.patch.object(communication.resource_tracker, 'unregister')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_small_and_large_messages_arrive_in_order(self):
+        sender = SharedMemorySender()
+        self.addCleanup(sender.close)
+        large = ' point[1 1]' * 100000
+        # There are two slots, so the sender can only be two large messages ahead of us
+        messages = [('a', 'small'), ('b', large), ('c', 'small again'), ('d', large + ' more')]
+        self.send(sender.send_response_and_data, messages)
+        receiver = BinaryReceiver(self.reader.fileno(), use_shared_memory=True)
+        self.assertEqual([receiver.read_message() for _ in messages], messages)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+''' Tests of compiling frames, and of folding together the changes that dropped frames make to the retained scene '''
+
+import unittest
+
+from streamcanvas.frame_compiler import (CompiledFrame, DroppedSceneEdits, EncodedFrameCache, FrameCompiler,
+                                          compile_frame)
+
+
+def _commands(frame):
+    ''' Return the commands of a compiled frame as (command, name, numbers) with the numbers as a list '''
+    return [(command, name, list(numbers)) for command, name, numbers in frame.commands()]
+
+
+class CompiledFrameTest(unittest.TestCase):
+
+    def test_commands_are_compiled(self):
+        frame = compile_frame(' colour[0xff000080] circle@a[0 1 2] pen[rpm 1 2] point[3 4] approve')
+        self.assertEqual(_commands(frame), [('colour', None, [1.0, 0.0, 0.0, 128 / 255]),
+                                            ('circle', 'a', [0.0, 1.0, 2.0]),
+                                            ('pen', 'rpm', [1.0, 2.0]),
+                                            ('point', None, [3.0, 4.0])])
+
+    def test_empty_colour_has_no_numbers(self):
+        self.assertEqual(_commands(compile_frame(' colour[] approve')), [('colour', None, [])])
+
+    def test_bad_commands_are_ignored(self):
+        frame = compile_frame(' unknown[1] point[a b] update[1 2] pen[] point[1 2] approve')
+        self.assertEqual(_commands(frame), [('point', None, [1.0, 2.0])])
+
+    def test_encoding_round_trips(self):
+        frame = compile_frame(' colour[0 1 0] circle[0 1 2] pen[rpm 1 2] pen[speed 3 4] pen[rpm 5 6] approve')
+        decoded = CompiledFrame.decode(frame.encode())
+        self.assertEqual(_commands(decoded), _commands(frame))
+        self.assertEqual(decoded.names, ['rpm', 'speed'])
+
+    def test_scene_edits_round_trip(self):
+        frame = compile_frame(' circle@a[0 1 2] update@a[5 5] delete@b[] approve')
+        decoded = CompiledFrame.decode(frame.encode())
+        self.assertEqual(_commands(decoded), _commands(frame))
+        self.assertEqual(decoded.names, frame.names)
+
+    def test_empty_frame_round_trips(self):
+        self.assertEqual(len(CompiledFrame.decode(CompiledFrame().encode())), 0)
+
+    def test_decoding_the_wrong_length_is_an_error(self):
+        with self.assertRaises(RuntimeError):
+            CompiledFrame.decode(compile_frame(' circle[0 1 2] approve').encode() + b'x')
+
+    def test_command_may_be_split_between_parts(self):
+        compiler = FrameCompiler()
+        first = compiler.compile(' point', new_frame=True)
+        second = compiler.compile(' [1 2] approve', new_frame=False)
+        self.assertEqual(_commands(first), [])
+        self.assertEqual(_commands(second), [('point', None, [1.0, 2.0])])
+
+    def test_decoded_arrays_are_views_of_the_payload(self):
+        payload = compile_frame(' point[1 2] approve').encode()
+        decoded = CompiledFrame.decode(payload)
+        self.assertIs(decoded.numbers.obj, payload)
+        self.assertEqual(list(decoded.numbers), [1.0, 2.0])
+
+    def test_cache_gives_the_same_encoding(self):
+        cache = EncodedFrameCache(size=1)
+        text = ' point[1 2] approve'
+        self.assertIs(cache.encode(text), cache.encode(text))
+        self.assertEqual(cache.encode(text), compile_frame(text).encode())
+
+
+
+class DroppedSceneEditsTest(unittest.TestCase):
+
+    def test_frames_without_ids_are_ignored(self):
+        edits = DroppedSceneEdits()
+        edits.add_frame('colour[1 0 0] point[1 1] approve')
+        self.assertEqual(len(edits), 0)
+        self.assertEqual(edits.take(), '')
+
+    def test_last_edit_of_each_id_is_kept(self):
+        edits = DroppedSceneEdits()
+        edits.add_frame('circle@a[0 0 1] circle@b[1 1 1] approve')
+        edits.add_frame('update@a[2 2 3] delete@b[] approve')
+        self.assertEqual(edits.take(), ' circle@a[2 2 3] delete@b[]')
+        self.assertEqual(edits.take(), '')
+
+    def test_update_after_delete_is_ignored(self):
+        edits = DroppedSceneEdits()
+        edits.add_frame('delete@a[] update@a[1 1] approve')
+        self.assertEqual(edits.take(), ' delete@a[]')
+
+    def test_colours_are_kept_and_undone(self):
+        edits = DroppedSceneEdits()
+        edits.add_frame('colour[1 0 0] point@a[1 1] colour[] point@b[2 2] approve')
+        self.assertEqual(edits.take(), ' colour[1 0 0] point@a[1 1] colour[] point@b[2 2]')
+        edits.add_frame('colour[0 1 0] point@a[1 1] approve')
+        self.assertEqual(edits.take(), ' colour[0 1 0] point@a[1 1] colour[]')
+
+    def test_part_of_bytes_may_be_given(self):
+        data = b'point@a[1 1] approve point@a[2 2] approve'
+        edits = DroppedSceneEdits()
+        edits.add_frame(data, 0, len(b'point@a[1 1] approve'))
+        self.assertEqual(edits.take(), ' point@a[1 1]')
+
+    def test_untokenized_text_is_folded(self):
+        edits = DroppedSceneEdits()
+        edits.add_frame('point@a[1\n 1] # update@a[5 5]\napprove')
+        self.assertEqual(edits.take(), ' point@a[1 1]')
+
+
+if __name__ == '__main__':
+    unittest.main()
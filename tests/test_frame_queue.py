@@ -0,0 +1,61 @@
+''' Tests of the queue of complete frames, which spills frames to disk beyond its memory budget '''
+
+import unittest
+
+from streamcanvas.frame_queue import FrameQueue
+
+
+class FrameQueueTest(unittest.TestCase):
+
+    def test_frames_come_out_in_order_whether_or_not_they_spill(self):
+        frames = [' point[{} {}] approve'.format(index, index) for index in range(20)] + [' text[é] approve', '']
+        queue = FrameQueue(memory_budget=50)
+        for frame in frames:
+            queue.append(frame)
+        self.assertEqual(len(queue), len(frames))
+        self.assertEqual(list(queue), frames)
+        self.assertEqual([queue.popleft() for _ in frames], frames)
+        self.assertEqual(len(queue), 0)
+
+    def test_frames_within_budget_stay_in_memory(self):
+        queue = FrameQueue(memory_budget=100)
+        queue.append(' point[1 1] approve')
+        self.assertIsNone(queue._spill_file)
+
+    def test_spill_file_is_reused_once_empty(self):
+        queue = FrameQueue(memory_budget=0)
+        queue.append(' point[1 1] approve')
+        self.assertEqual(queue.popleft(), ' point[1 1] approve')
+        self.assertEqual(queue._spill_size, 0)
+        queue.append(' point[2 2] approve')
+        self.assertEqual(queue.popleft(), ' point[2 2] approve')
+
+    def test_interleaved_appends_and_pops(self):
+        queue = FrameQueue(memory_budget=30)
+        expected = []
+        for index in range(10):
+            for frame in (' a[{}] approve'.format(index), ' b[{}] approve'.format(index)):
+                queue.append(frame)
+                expected.append(frame)
+            self.assertEqual(queue.popleft(), expected.pop(0))
+        self.assertEqual(list(queue), expected)
+
+    def test_keep_last(self):
+        queue = FrameQueue(memory_budget=20)
+        for index in range(5):
+            queue.append(' point[{} {}] approve'.format(index, index))
+        queue.keep_last()
+        self.assertEqual(list(queue), [' point[4 4] approve'])
+
+    def test_clear(self):
+        queue = FrameQueue(memory_budget=10)
+        for index in range(5):
+            queue.append(' point[{} {}] approve'.format(index, index))
+        queue.clear()
+        self.assertEqual(len(queue), 0)
+        queue.append(' point[5 5] approve')
+        self.assertEqual(list(queue), [' point[5 5] approve'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+''' Tests of the gobbler's store of frames, which tokenizes frames as they arrive or scans for them when dropping '''
+
+import os
+import unittest
+
+from unittest import mock
+
+from streamcanvas import gobbler
+from streamcanvas.constants import (RESPONSE_BEGIN_PARTIAL_FRAME, RESPONSE_COMPLETE_FRAME,
+                                    RESPONSE_CONTINUE_PARTIAL_FRAME, RESPONSE_END_PARTIAL_FRAME,
+                                    RESPONSE_NO_NEXT_FRAME, SIGNAL_MORE_OF_SAME_FRAME, SIGNAL_NEXT_FRAME)
+from streamcanvas.gobbler import FrameStore, OptionsStore, PlotterNotifier, StoreSelector, _take_frame_data
+from streamcanvas.options import OPTIONS
+
+
+class FrameStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FrameStore()
+
+    def next_frame(self):
+        return self.store.get_response_and_data(SIGNAL_NEXT_FRAME)
+
+    def test_no_frame_until_there_is_data(self):
+        self.assertEqual(self.next_frame(), (RESPONSE_NO_NEXT_FRAME, ''))
+
+    def test_every_frame_is_kept_in_order(self):
+        self.store.add_text('point[1 1] approve\npoint[2\n 2] # comment\napprove point[3')
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[1 1] approve'))
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[2\n 2] approve'))
+        self.store.add_text(' 3] approve ')
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[3 3] approve'))
+        self.assertEqual(self.next_frame(), (RESPONSE_NO_NEXT_FRAME, ''))
+
+    def test_partial_frame_is_delivered_in_parts(self):
+        self.store.add_text('point[1 1] ')
+        self.assertEqual(self.next_frame(), (RESPONSE_BEGIN_PARTIAL_FRAME, ' point[1 1]'))
+        self.store.add_text('point[2 2] ')
+        self.assertEqual(self.store.get_response_and_data(SIGNAL_MORE_OF_SAME_FRAME),
+                         (RESPONSE_CONTINUE_PARTIAL_FRAME, ' point[2 2]'))
+        self.store.add_text('point[3 3] approve point[4 4] approve ')
+        self.assertEqual(self.store.get_response_and_data(SIGNAL_MORE_OF_SAME_FRAME),
+                         (RESPONSE_END_PARTIAL_FRAME, ' point[3 3] approve'))
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[4 4] approve'))
+
+    def test_more_of_a_frame_that_was_never_begun_is_an_error(self):
+        with self.assertRaises(RuntimeError):
+            self.store.get_response_and_data(SIGNAL_MORE_OF_SAME_FRAME)
+
+    def test_only_the_newest_frame_is_kept_when_dropping(self):
+        self.store.store_all_frames = False
+        self.store.add_text(''.join('point[{0} {0}] approve\n'.format(index) for index in range(10)))
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[9 9] approve'))
+        self.assertEqual(self.next_frame(), (RESPONSE_NO_NEXT_FRAME, ''))
+
+    def test_scanned_frames_are_tokenized_when_delivered(self):
+        self.store.store_all_frames = False
+        self.store.add_text('point[0 0] approve ')
+        self.assertIsNotNone(self.store._scanner)
+        self.store.add_text("text['approve' 1\n 1] # approve\n")
+        self.store.add_text('approve point[2 2] point[3')
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, " text['approve' 1\n 1] approve"))
+        # A token that is yet to finish stays with the rest of the frame
+        self.assertEqual(self.next_frame(), (RESPONSE_BEGIN_PARTIAL_FRAME, ' point[2 2]'))
+        self.store.add_text(' 3] approve')
+        self.store.finish()
+        self.assertEqual(self.store.get_response_and_data(SIGNAL_MORE_OF_SAME_FRAME),
+                         (RESPONSE_END_PARTIAL_FRAME, ' point[3 3] approve'))
+
+    def test_newer_complete_frame_pre_empts_a_partial_one(self):
+        self.store.store_all_frames = False
+        self.store.add_text('point[0 0] approve point[1 1] ')
+        # A partial frame isn't begun while there is a complete one to deliver
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[0 0] approve'))
+        self.store.add_text('approve point[2 2] approve point[3')
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[2 2] approve'))
+        self.assertEqual(self.next_frame(), (RESPONSE_NO_NEXT_FRAME, ''))
+
+    def test_frames_are_kept_again_once_we_stop_dropping(self):
+        self.store.store_all_frames = False
+        self.store.add_text('point[0 0] approve point[1 1] approve point[2')
+        self.store.store_all_frames = True
+        self.assertIsNone(self.store._scanner)
+        self.store.add_text(' 2] approve point[3 3] approve ')
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[1 1] approve'))
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[2 2] approve'))
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' point[3 3] approve'))
+
+    def test_retained_scene_edits_of_dropped_frames_are_kept(self):
+        self.store.store_all_frames = False
+        self.store.add_text('circle@a[0 0 1] approve update@a[1 1 1] approve point[2 2] approve ')
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' circle@a[1 1 1] point[2 2] approve'))
+
+    def test_catch_up_keeps_the_newest_frame(self):
+        self.store.add_text('circle@a[0 0 1] approve point[1 1] approve point[2 2] approve ')
+        self.store.catch_up()
+        self.assertEqual(self.next_frame(), (RESPONSE_COMPLETE_FRAME, ' circle@a[0 0 1] point[2 2] approve'))
+        self.assertEqual(self.next_frame(), (RESPONSE_NO_NEXT_FRAME, ''))
+
+
+class StoreSelectorTest(unittest.TestCase):
+
+    def setUp(self):
+        # The selector passes text on to the gobbler's own stores, so we give it fresh ones
+        self.frame_store = FrameStore()
+        for name, store in (('_FRAME_STORE', self.frame_store), ('_OPTIONS_STORE', OptionsStore())):
+            patcher = mock.patch.object(gobbler, name, store)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(setattr, OPTIONS, 'frame_memory_mb', OPTIONS.frame_memory_mb)
+
+    def test_options_block_sets_the_frame_memory_budget(self):
+        StoreSelector().add_text('options frame_memory_mb 3 endoptions point[1 1] approve ')
+        self.assertEqual(self.frame_store.complete_frames.memory_budget, 3 << 20)
+        self.assertEqual(self.frame_store.get_response_and_data(SIGNAL_NEXT_FRAME),
+                         (RESPONSE_COMPLETE_FRAME, ' point[1 1] approve'))
+
+
+class PlotterNotifierTest(unittest.TestCase):
+
+    def setUp(self):
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        self.addCleanup(os.close, read_fd)
+        self.addCleanup(os.close, write_fd)
+        self.read_fd = read_fd
+        notifier = PlotterNotifier()
+        notifier.fd = write_fd
+        notifier.enabled = True
+        patcher = mock.patch.object(gobbler, '_PLOTTER_NOTIFIER', notifier)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def num_notifications(self):
+        try:
+            return len(os.read(self.read_fd, 64))
+        except BlockingIOError:
+            return 0
+
+    def test_plotter_is_notified_until_queued_frames_are_taken(self):
+        store = FrameStore()
+        store.add_text('point[0 0] approve point[1 1] approve point[2 2] approve ')
+        gobbler._PLOTTER_NOTIFIER.notify()
+        self.assertEqual(self.num_notifications(), 1)
+
+        # No more input arrives, so only the frames still queued can tell the plotter to come back
+        for index in range(3):
+            response, data = _take_frame_data(store, SIGNAL_NEXT_FRAME)
+            self.assertEqual((response, data), (RESPONSE_COMPLETE_FRAME, ' point[{0} {0}] approve'.format(index)))
+            self.assertEqual(self.num_notifications(), 1 if index < 2 else 0)
+
+    def test_plotter_is_notified_once_until_it_asks_again(self):
+        notifier = gobbler._PLOTTER_NOTIFIER
+        notifier.notify()
+        notifier.notify()
+        self.assertEqual(self.num_notifications(), 1)
+        notifier.data_requested()
+        notifier.notify()
+        self.assertEqual(self.num_notifications(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+''' Tests of splitting the input stream into tokens, and of scanning it for the ends of frames '''
+
+import unittest
+
+from streamcanvas.tokenizer import FrameScanner, Tokenizer, join_tokens, tokenize_frame
+
+
+def _tokens(chunks):
+    ''' Return the tokens in the given chunks of text, fed to a tokenizer one at a time '''
+    tokens = []
+    tokenizer = Tokenizer(tokens.append)
+    for chunk in chunks:
+        tokenizer.feed(chunk)
+    tokenizer.finish()
+    return tokens
+
+
+def _frame_ends(chunks, binary=False):
+    ''' Return the offsets of the frame ends in the given chunks of text, given to a scanner one at a time '''
+    scanner = FrameScanner(binary)
+    frame_ends = []
+    for chunk in chunks:
+        frame_ends.extend(scanner.scan(chunk))
+    frame_ends.extend(scanner.finish())
+    return frame_ends
+
+
+class TokenizerTest(unittest.TestCase):
+
+    def test_tokens_are_split_at_separators_outside_delimiters(self):
+        self.assertEqual(_tokens(['circle[0 0 1]\tpoint (1 2)\napprove']),
+                         ['circle[0 0 1]', 'point', '(1 2)', 'approve'])
+
+    def test_chunks_may_split_tokens_anywhere(self):
+        text = "circle[0 0 1] text['a b' 1 2] # comment\napprove "
+        expected = _tokens([text])
+        for split in range(len(text) + 1):
+            self.assertEqual(_tokens([text[:split], text[split:]]), expected)
+
+    def test_comments_are_ignored(self):
+        self.assertEqual(_tokens(['point[1 1]# a comment [\napprove']), ['point[1 1]', 'approve'])
+
+    def test_comment_within_delimiters_is_whitespace(self):
+        self.assertEqual(_tokens(['lines[0 0 # first\n1 1]']), ['lines[0 0  1 1]'])
+
+    def test_strings_may_contain_delimiters(self):
+        self.assertEqual(_tokens(["text['] # [' 1 2]"]), ["text['] # [' 1 2]"])
+
+    def test_unmatched_closing_delimiter_is_an_error(self):
+        with self.assertRaises(RuntimeError):
+            _tokens(['point[1 1]]'])
+
+    def test_stopping_leaves_the_rest_unconsumed(self):
+        tokens = []
+        tokenizer = Tokenizer(lambda token: tokens.append(token) or token == 'approve')
+        text = 'point[1 1] approve circle[0 0 1]'
+        num_consumed = tokenizer.feed(text)
+        self.assertEqual(tokens, ['point[1 1]', 'approve'])
+        self.assertEqual(text[num_consumed:], ' circle[0 0 1]')
+
+    def test_tokenize_frame_is_idempotent(self):
+        frame = tokenize_frame('point[1 1]  # comment\n circle[0 0 1]\napprove')
+        self.assertEqual(frame, ' point[1 1] circle[0 0 1] approve')
+        self.assertEqual(tokenize_frame(frame), frame)
+
+    def test_joined_tokens_are_each_preceded_by_a_space(self):
+        self.assertEqual(join_tokens([]), '')
+        self.assertEqual(join_tokens(['point[1 1]', 'approve']), ' point[1 1] approve')
+
+
+class FrameScannerTest(unittest.TestCase):
+
+    def test_frame_ends_are_found(self):
+        text = 'point[1 1] approve circle[0 0 1] approve\n'
+        self.assertEqual(_frame_ends([text]), [len('point[1 1] approve'), len(text) - 1])
+
+    def test_chunks_may_split_the_end_of_frame_token(self):
+        text = 'point[1 1] approve point[2 2] approve'
+        expected = _frame_ends([text])
+        self.assertEqual(len(expected), 2)
+        for split in range(len(text) + 1):
+            self.assertEqual(_frame_ends([text[:split], text[split:]]), expected)
+        self.assertEqual(_frame_ends(list(text)), expected)
+
+    def test_end_of_frame_must_stand_alone(self):
+        self.assertEqual(_frame_ends(['disapprove approved approve_ x']), [])
+
+    def test_end_of_frame_may_be_followed_by_a_comment(self):
+        self.assertEqual(_frame_ends(['approve# done']), [len('approve')])
+
+    def test_end_of_frame_is_ignored_in_comments_strings_and_delimiters(self):
+        text = "# approve \ntext['approve ' 1 2] lines[approve ] approve"
+        self.assertEqual(_frame_ends([text]), [len(text)])
+
+    def test_finish_finds_a_frame_end_at_the_end_of_input(self):
+        scanner = FrameScanner()
+        self.assertEqual(scanner.scan('point[1 1] approve'), [])
+        self.assertEqual(scanner.finish(), [len('point[1 1] approve')])
+
+    def test_bytes_are_scanned_like_text(self):
+        text = "text['é approve'] approve point[1 1] approve"
+        data = text.encode('utf-8')
+        frame_ends = _frame_ends([data[:13], data[13:]], binary=True)
+        self.assertEqual([data[:end].decode('utf-8') for end in frame_ends],
+                         [text[:end] for end in _frame_ends([text])])
+
+    def test_frame_ends_agree_with_the_tokenizer(self):
+        text = "point[1 1] approve text['approve' 0 0] # approve\n approve lines[(1 2)] approve"
+        frame_ends = _frame_ends([text])
+        starts = [0] + frame_ends[:-1]
+        frames = [_tokens([text[start:end]]) for start, end in zip(starts, frame_ends)]
+        self.assertTrue(all(frame[-1] == 'approve' and frame.count('approve') == 1 for frame in frames))
+        self.assertEqual(sum(frames, []), _tokens([text]))
+
+
+if __name__ == '__main__':
+    unittest.main()